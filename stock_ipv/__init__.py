@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
 
 from . import controllers
-from . import models
\ No newline at end of file
+from . import models
+from . import wizard
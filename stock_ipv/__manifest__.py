@@ -16,7 +16,7 @@
     # Check https://github.com/odoo/odoo/blob/12.0/odoo/addons/base/data/ir_module_category_data.xml
     # for the full list
     'category': 'Uncategorized',
-    'version': '0.1',
+    'version': '0.5',
 
     # any module necessary for this one to work correctly
     'depends': ['stock',
@@ -28,8 +28,12 @@
         'security/ir.model.access.csv',
         'data/stock_ipv_data.xml',
         'views/stock_ipv_menu.xml',
+        'views/work_place_view.xml',
+        'views/stock_ipv_sheet_view.xml',
         'views/stock_ipv_view.xml',
         'views/product_view.xml',
+        'views/report_stock_ipv_consumption_view.xml',
+        'views/stock_ipv_perf_log_view.xml',
     ],
     # only loaded in demonstration mode
     'demo': [
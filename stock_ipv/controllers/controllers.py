@@ -1,20 +1,11 @@
 # -*- coding: utf-8 -*-
 from odoo import http
+from odoo.http import request
 
-# class StockIpv(http.Controller):
-#     @http.route('/stock_ipv/stock_ipv/', auth='public')
-#     def index(self, **kw):
-#         return "Hello, world"
 
-#     @http.route('/stock_ipv/stock_ipv/objects/', auth='public')
-#     def list(self, **kw):
-#         return http.request.render('stock_ipv.listing', {
-#             'root': '/stock_ipv/stock_ipv',
-#             'objects': http.request.env['stock_ipv.stock_ipv'].search([]),
-#         })
+class StockIpv(http.Controller):
 
-#     @http.route('/stock_ipv/stock_ipv/objects/<model("stock_ipv.stock_ipv"):obj>/', auth='public')
-#     def object(self, obj, **kw):
-#         return http.request.render('stock_ipv.object', {
-#             'object': obj
-#         })
\ No newline at end of file
+    @http.route('/stock_ipv/<int:ipv_id>/demand', type='json', auth='user')
+    def set_demand(self, ipv_id, demand, **kw):
+        """Set the demand sheet ``{product_id: qty}`` of an IPV and return its updated lines."""
+        return request.env['stock.ipv'].browse(ipv_id).set_demand(demand)
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, SUPERUSER_ID
+
+
+def migrate(cr, version):
+    """Backfill the now stored IPV and IPV line states."""
+    if not version:
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    # Las lineas primero, el estado del IPV no depende de ellas pero si de sus pickings
+    for model in ('stock.ipv.line', 'stock.ipv'):
+        records = env[model].with_context(active_test=False).search([])
+        env.add_todo(records._fields['state'], records)
+        records.recompute()
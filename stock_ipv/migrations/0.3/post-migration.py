@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+
+def migrate(cr, version):
+    """Backfill final_stock_qty of the already closed IPVs from the moves done up to their close date."""
+    if not version:
+        return
+    cr.execute("""
+        WITH closing AS (
+            SELECT l.id AS line_id,
+                   (SELECT COALESCE(SUM(CASE WHEN m.location_dest_id = loc.location_id THEN m.product_qty
+                                             ELSE -m.product_qty END), 0.0)
+                      FROM stock_move m
+                     WHERE m.product_id = l.product_id
+                       AND m.state = 'done'
+                       AND m.date <= ipv.date_close
+                       AND m.location_id != m.location_dest_id
+                       AND (m.location_id = loc.location_id OR m.location_dest_id = loc.location_id)
+                   ) AS qty
+              FROM stock_ipv_line l
+              JOIN stock_ipv ipv ON ipv.id = l.ipv_id
+              JOIN ipv_work_place wp ON wp.id = ipv.workplace_id
+              JOIN product_product pp ON pp.id = l.product_id
+              JOIN product_template pt ON pt.id = pp.product_tmpl_id
+              CROSS JOIN LATERAL (
+                  SELECT CASE WHEN pt.available_in_pos AND NOT COALESCE(l.is_raw, FALSE) THEN wp.sales_loc
+                              ELSE COALESCE(pt.elaboration_loc, wp.elaboration_loc) END AS location_id
+              ) loc
+             WHERE ipv.state = 'close'
+        )
+        UPDATE stock_ipv_line l
+           SET final_stock_qty = closing.qty
+          FROM closing
+         WHERE closing.line_id = l.id
+    """)
+    cr.execute('REFRESH MATERIALIZED VIEW report_stock_ipv_consumption')
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+
+def migrate(cr, version):
+    """Fill the now stored elaboration area of the IPV lines.
+
+    Products and intermediates take the area of their product, as the related field did. Plain raw
+    materials take the area of the products they are used in, the key prepare_raw_materials matches them
+    by, so the raws of the IPVs in progress are found again instead of duplicated."""
+    if not version:
+        return
+    cr.execute("""
+        UPDATE stock_ipv_line l
+           SET elaboration_loc = pt.elaboration_loc
+          FROM product_product pp
+          JOIN product_template pt ON pt.id = pp.product_tmpl_id
+         WHERE pp.id = l.product_id
+           AND l.elaboration_loc IS NULL
+           AND pt.elaboration_loc IS NOT NULL
+           AND NOT (COALESCE(l.is_raw, FALSE) AND NOT COALESCE(l.is_manufactured, FALSE))
+    """)
+    # En stock_ipv_product_raws_rel la columna parent_id es la materia prima y raw_id el producto
+    cr.execute("""
+        WITH parent_area AS (
+            SELECT r.parent_id AS line_id,
+                   MIN(COALESCE(p.elaboration_loc, wp.elaboration_loc)) AS location_id
+              FROM stock_ipv_product_raws_rel r
+              JOIN stock_ipv_line p ON p.id = r.raw_id
+              JOIN stock_ipv ipv ON ipv.id = p.ipv_id
+              JOIN ipv_work_place wp ON wp.id = ipv.workplace_id
+          GROUP BY r.parent_id
+        )
+        UPDATE stock_ipv_line l
+           SET elaboration_loc = parent_area.location_id
+          FROM parent_area
+         WHERE parent_area.line_id = l.id
+           AND COALESCE(l.is_raw, FALSE)
+           AND NOT COALESCE(l.is_manufactured, FALSE)
+    """)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, SUPERUSER_ID
+
+
+def migrate(cr, version):
+    """Backfill the POS sales of the open and closed IPVs from the paid orders of their turn.
+
+    The orders are recorded in stock_ipv_pos_order_rel by the same statement that adds their quantities, so
+    the open IPVs do not count them again, the closed ones are reconciled with their consumption."""
+    if not version:
+        return
+    cr.execute("""
+        WITH new_orders AS (
+            INSERT INTO stock_ipv_pos_order_rel (ipv_id, order_id)
+            SELECT ipv.id, o.id
+              FROM stock_ipv ipv
+              JOIN ipv_work_place wp ON wp.id = ipv.workplace_id
+              JOIN pos_order o ON o.location_id = wp.sales_loc
+             WHERE ipv.state IN ('open', 'close')
+               AND ipv.date_open IS NOT NULL
+               AND o.state IN ('paid', 'done', 'invoiced')
+               AND o.date_order >= ipv.date_open
+               AND (ipv.date_close IS NULL OR o.date_order <= ipv.date_close)
+                ON CONFLICT DO NOTHING
+         RETURNING ipv_id, order_id
+        )
+        INSERT INTO stock_ipv_pos_sale (ipv_id, product_id, sold_qty, consumed_qty, difference_qty,
+                                        create_uid, create_date, write_uid, write_date)
+        SELECT o.ipv_id, l.product_id, SUM(l.qty), 0.0, 0.0,
+               %(uid)s, NOW() AT TIME ZONE 'UTC', %(uid)s, NOW() AT TIME ZONE 'UTC'
+          FROM pos_order_line l
+          JOIN new_orders o ON o.order_id = l.order_id
+      GROUP BY o.ipv_id, l.product_id
+            ON CONFLICT (ipv_id, product_id)
+            DO UPDATE SET sold_qty = stock_ipv_pos_sale.sold_qty + EXCLUDED.sold_qty,
+                          write_date = EXCLUDED.write_date
+    """, {'uid': SUPERUSER_ID})
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    env['stock.ipv'].search([('state', '=', 'close')])._reconcile_pos_sales()
@@ -6,3 +6,11 @@ from . import stock_move
 from . import stock_picking
 from . import work_place
 from . import product
+from . import stock_quant
+from . import mrp_bom
+from . import stock_ipv_queue
+from . import stock_ipv_perf_log
+from . import stock_ipv_pos_sale
+from . import stock_ipv_summary
+# Las vistas de reporte al final, dependen de las tablas de los demas modelos
+from . import report_stock_ipv_consumption
@@ -0,0 +1,163 @@
+from collections import defaultdict
+
+from odoo import models, api, tools, _
+from odoo.exceptions import UserError
+
+# Campos de la lista de materiales que cambian las materias primas de las lineas de IPV
+BOM_STRUCTURE_FIELDS = {'bom_line_ids', 'product_qty', 'product_uom_id', 'product_id', 'product_tmpl_id',
+                        'active', 'type'}
+
+
+class MrpBom(models.Model):
+    _inherit = 'mrp.bom'
+
+    @tools.ormcache('self.id', 'product_id')
+    def _ipv_explode_unit(self, product_id):
+        """Components of one unit (in the BoM UoM) of ``product_id``, phantom BoMs exploded.
+
+        Quantities are not rounded: explode rounds every line up, and scaling a rounded unit would multiply
+        the rounding by the demand. Callers scale this result and round once.
+
+        :return: tuple of (component product id, quantity in the component UoM)
+        """
+        quantities = defaultdict(float)
+        self._ipv_explode_lines(self.env['product.product'].browse(product_id), 1.0 / self.product_qty,
+                                quantities, set())
+        return tuple(quantities.items())
+
+    def _ipv_explode_lines(self, product, factor, quantities, visited):
+        """Add to ``quantities`` the components of ``factor`` times this BoM, like explode without rounding."""
+        if self.id in visited:
+            raise UserError(_('Recursion error!  A product with a Bill of Material should not have itself '
+                              'in its BoM or child BoMs!'))
+        visited = visited | {self.id}
+        for boml in self.bom_line_ids:
+            if boml._skip_bom_line(product):
+                continue
+            line_qty = factor * boml.product_qty
+            bom = self._bom_find(product=boml.product_id, picking_type=self.picking_type_id,
+                                 company_id=self.company_id.id)
+            if bom.type == 'phantom':
+                bom_qty = boml.product_uom_id._compute_quantity(line_qty, bom.product_uom_id, round=False)
+                bom._ipv_explode_lines(boml.product_id, bom_qty / bom.product_qty, quantities, visited)
+            else:
+                quantities[boml.product_id.id] += boml.product_uom_id._compute_quantity(
+                    line_qty, boml.product_id.uom_id, round=False)
+
+    @api.model
+    @tools.ormcache('product_id', 'self.env.context.get("company_id")')
+    def _ipv_get_product_bom(self, product_id):
+        """BoM found for ``product_id`` and whether it is a normal one, cached until a BoM changes.
+
+        :return: tuple (bom id or False, is normal)
+        """
+        bom = self._bom_find(product=self.env['product.product'].browse(product_id))
+        return bom.id, bom.type == 'normal'
+
+    def _get_ipv_products(self):
+        return self.mapped('product_id') | self.mapped('product_tmpl_id.product_variant_ids')
+
+    @api.model
+    def _ipv_get_lines(self, products, boms):
+        """Lines of ``products`` whose structure can follow a change of ``boms``: the ones of draft IPVs
+        without moves that use one of them or no BoM at all. Lines already moving stock keep the raws they
+        were opened with, and lines using another BoM keep it."""
+        return self.env['stock.ipv.line'].search([('product_id', 'in', products.ids),
+                                                  ('ipv_id.state', '=', 'draft'),
+                                                  ('move_ids', '=', False),
+                                                  '|', ('bom_id', '=', False), ('bom_id', 'in', boms.ids)])
+
+    @api.model
+    def _ipv_release_lines(self, lines):
+        """Drop the raws of ``lines`` before their BoM changes, it is still needed to explode the demand
+        taken from the shared raws."""
+        manufactured = lines.filtered('is_manufactured')
+        if not manufactured:
+            return
+        raws = manufactured.mapped('raw_ids') - manufactured
+        raws.filtered(lambda r: not (r.parent_ids - manufactured)).unlink()
+        manufactured.exists().update_request_qty()
+        manufactured.exists().write({'raw_ids': [(5,)]})
+
+    def _ipv_applies_to(self, product):
+        """Whether this BoM can still be used by a line of ``product``."""
+        self.ensure_one()
+        if not self.exists() or not self.active or self.type != 'normal':
+            return False
+        if self.product_id:
+            return self.product_id == product
+        return self.product_tmpl_id == product.product_tmpl_id
+
+    @api.model
+    def _ipv_refresh_lines(self, lines):
+        """Recompute is_manufactured of ``lines`` and prepare their raws again.
+
+        A line keeps its BoM while it can still be used, lines without BoM or whose BoM was removed, archived
+        or moved to another product take the default one."""
+        lines = lines.exists()
+        if not lines:
+            return
+        self.env.add_todo(lines._fields['is_manufactured'], lines)
+        lines.recompute()
+        IpvLine = self.env['stock.ipv.line']
+        lines_by_bom = defaultdict(lambda: IpvLine)
+        for ipvl in lines:
+            bom = ipvl.bom_id
+            if not bom or not bom._ipv_applies_to(ipvl.product_id):
+                bom = IpvLine._get_default_bom(ipvl.product_id)
+            lines_by_bom[bom] |= ipvl
+        for bom, bom_lines in lines_by_bom.items():
+            if bom:
+                # Escribir el bom_id prepara las materias primas
+                bom_lines.write({'bom_id': bom.id})
+            else:
+                bom_lines.filtered('bom_id').write({'bom_id': False})
+
+    @api.model
+    def create(self, vals):
+        self.clear_caches()
+        res = super(MrpBom, self).create(vals)
+        # Solo las lineas sin lista de materiales pueden pasar a usar la nueva
+        self._ipv_refresh_lines(self._ipv_get_lines(res._get_ipv_products(), self.browse()))
+        return res
+
+    @api.multi
+    def write(self, vals):
+        if not BOM_STRUCTURE_FIELDS.intersection(vals):
+            # La secuencia puede cambiar la lista de materiales por defecto
+            self.clear_caches()
+            return super(MrpBom, self).write(vals)
+        lines = self._ipv_get_lines(self._get_ipv_products(), self)
+        self._ipv_release_lines(lines)
+        self.clear_caches()
+        res = super(MrpBom, self).write(vals)
+        self._ipv_refresh_lines(lines | self._ipv_get_lines(self._get_ipv_products(), self.browse()))
+        return res
+
+    @api.multi
+    def unlink(self):
+        lines = self._ipv_get_lines(self._get_ipv_products(), self)
+        self._ipv_release_lines(lines)
+        self.clear_caches()
+        res = super(MrpBom, self).unlink()
+        self._ipv_refresh_lines(lines)
+        return res
+
+
+class MrpBomLine(models.Model):
+    _inherit = 'mrp.bom.line'
+
+    @api.model
+    def create(self, vals):
+        self.clear_caches()
+        return super(MrpBomLine, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        self.clear_caches()
+        return super(MrpBomLine, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        return super(MrpBomLine, self).unlink()
@@ -1,5 +1,9 @@
 
 from odoo import models, fields, api
+from odoo.osv import expression
+
+# Campos de la plantilla que cambian el catalogo, el archivado se propaga a las variantes
+CATALOGUE_FIELDS = {'workplace_ids', 'available_in_pos', 'type'}
 
 
 class ProductTemplate(models.Model):
@@ -10,3 +14,76 @@ class ProductTemplate(models.Model):
                                       domain=[('usage', 'in', ['internal'])],
                                       help='Location overwrite where this product is elaborated'
                                       )
+
+    @api.multi
+    def write(self, vals):
+        res = super(ProductTemplate, self).write(vals)
+        if CATALOGUE_FIELDS.intersection(vals):
+            self.env['ipv.work.place']._refresh_catalogue_products(
+                self.with_context(active_test=False).mapped('product_variant_ids'))
+        return res
+
+
+class ProductProduct(models.Model):
+    _inherit = 'product.product'
+
+    ipv_catalogue_ids = fields.Many2many('ipv.work.place', 'ipv_work_place_catalogue_rel', 'product_id', 'workplace_id',
+                                         string='IPV Catalogues', readonly=True,
+                                         help='Work places where this product can be added to an IPV')
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        # Las variantes creadas desde la plantilla tambien pasan por aqui
+        res = super(ProductProduct, self).create(vals_list)
+        self.env['ipv.work.place']._refresh_catalogue_products(
+            res.filtered(lambda p: p.available_in_pos and p.type == 'product'))
+        return res
+
+    @api.multi
+    def write(self, vals):
+        res = super(ProductProduct, self).write(vals)
+        if 'active' in vals:
+            self.env['ipv.work.place']._refresh_catalogue_products(self)
+        return res
+
+    @api.model
+    def _get_ipv_excluded_products(self):
+        """Products already in the IPV being edited, from its saved lines and the unsaved changes of the form.
+
+        The context has the IPV id in ``ipv_exclude_ipv_id`` and the one2many commands of its saleable lines
+        in ``ipv_exclude_lines``, a new IPV only has the commands."""
+        ipv_id = self.env.context.get('ipv_exclude_ipv_id')
+        line_products = {}
+        if ipv_id:
+            self.env.cr.execute("""
+                SELECT id, product_id
+                  FROM stock_ipv_line
+                 WHERE ipv_id = %s
+                   AND NOT COALESCE(is_raw, FALSE)
+            """, (ipv_id,))
+            line_products = dict(self.env.cr.fetchall())
+        new_products = set()
+        for command in self.env.context.get('ipv_exclude_lines') or []:
+            if not isinstance(command, (list, tuple)) or not command:
+                continue
+            if command[0] in (2, 3):
+                line_products.pop(command[1], None)
+            elif command[0] == 5:
+                line_products.clear()
+            elif command[0] in (0, 1) and isinstance(command[2], dict) and 'product_id' in command[2]:
+                line_products.pop(command[1], None)
+                product_id = command[2]['product_id']
+                if isinstance(product_id, (list, tuple)):
+                    product_id = product_id[0] if product_id else False
+                if product_id:
+                    new_products.add(product_id)
+        return set(line_products.values()) | new_products
+
+    @api.model
+    def _name_search(self, name='', args=None, operator='ilike', limit=100, name_get_uid=None):
+        # Excluir en el servidor los productos que ya estan en el IPV
+        product_ids = self._get_ipv_excluded_products()
+        if product_ids:
+            args = expression.AND([args or [], [('id', 'not in', list(product_ids))]])
+        return super(ProductProduct, self)._name_search(name, args=args, operator=operator, limit=limit,
+                                                       name_get_uid=name_get_uid)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api
+
+
+class ReportStockIpvConsumption(models.Model):
+    _name = 'report.stock.ipv.consumption'
+    _description = 'IPV Consumption Report'
+    _auto = False
+    _order = 'date desc'
+
+    ipv_id = fields.Many2one('stock.ipv', 'IPV', readonly=True)
+    workplace_id = fields.Many2one('ipv.work.place', 'Work Place', readonly=True)
+    product_id = fields.Many2one('product.product', 'Product', readonly=True)
+    is_raw = fields.Boolean('Is Raw Material', readonly=True)
+    date = fields.Date('Close Date', readonly=True)
+    initial_stock_qty = fields.Float('Initial Stock', readonly=True)
+    request_qty = fields.Float('Demand', readonly=True)
+    final_stock_qty = fields.Float('Final Stock', readonly=True)
+    consumed_qty = fields.Float('Consumed', readonly=True)
+
+    def _query(self):
+        return """
+            SELECT
+                l.id AS id,
+                l.ipv_id AS ipv_id,
+                ipv.workplace_id AS workplace_id,
+                l.product_id AS product_id,
+                COALESCE(l.is_raw, FALSE) AS is_raw,
+                ipv.date_close::date AS date,
+                COALESCE(l.initial_stock_qty, 0.0) AS initial_stock_qty,
+                COALESCE(l.request_qty, 0.0) AS request_qty,
+                COALESCE(l.final_stock_qty, 0.0) AS final_stock_qty,
+                COALESCE(l.initial_stock_qty, 0.0) + COALESCE(l.request_qty, 0.0)
+                    - COALESCE(l.final_stock_qty, 0.0) AS consumed_qty
+            FROM stock_ipv_line l
+            JOIN stock_ipv ipv ON ipv.id = l.ipv_id
+            WHERE ipv.state = 'close'
+            UNION ALL
+            -- Turnos archivados, ids negativos para no chocar con los de las lineas
+            SELECT
+                -s.id AS id,
+                s.ipv_id AS ipv_id,
+                s.workplace_id AS workplace_id,
+                s.product_id AS product_id,
+                s.is_raw AS is_raw,
+                s.date_close::date AS date,
+                s.initial_stock_qty AS initial_stock_qty,
+                s.request_qty AS request_qty,
+                s.final_stock_qty AS final_stock_qty,
+                s.consumed_qty AS consumed_qty
+            FROM stock_ipv_summary s
+        """
+
+    @api.model_cr
+    def init(self):
+        self.env.cr.execute('DROP MATERIALIZED VIEW IF EXISTS %s' % self._table)
+        self.env.cr.execute('CREATE MATERIALIZED VIEW %s AS (%s)' % (self._table, self._query()))
+        # Necesario para refrescar de forma concurrente
+        self.env.cr.execute('CREATE UNIQUE INDEX %s_id_idx ON %s (id)' % (self._table, self._table))
+        self.env.cr.execute('CREATE INDEX %s_workplace_date_idx ON %s (workplace_id, date)'
+                            % (self._table, self._table))
+
+    @api.model
+    def _refresh_view(self):
+        """Refresh the frozen consumption without blocking the readers of the report."""
+        self.env.cr.execute('REFRESH MATERIALIZED VIEW CONCURRENTLY %s' % self._table)
+
+    @api.model
+    def _cron_refresh_view(self):
+        """Cron: refresh the report when turns were closed since the last refresh.
+
+        Closing a turn does not refresh the report, the refresh holds its lock until commit and would
+        serialize the closes of a shift change behind the whole history."""
+        ICP = self.env['ir.config_parameter'].sudo()
+        self.env.cr.execute('SELECT MAX(date_close) FROM stock_ipv')
+        last_close = self.env.cr.fetchone()[0]
+        refreshed_at = ICP.get_param('stock_ipv.report_refreshed_at')
+        if not last_close or (refreshed_at and fields.Datetime.to_string(last_close) <= refreshed_at):
+            return
+        self._refresh_view()
+        ICP.set_param('stock_ipv.report_refreshed_at', fields.Datetime.to_string(last_close))
@@ -1,8 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import random
+import time
+from collections import defaultdict
+from datetime import timedelta
+from itertools import groupby
+
+import pytz
+from psycopg2 import errorcodes, OperationalError
+
 from odoo import models, fields, api
 from odoo.tools.float_utils import float_compare, float_is_zero, float_round
-from odoo.exceptions import UserError
+from odoo.exceptions import UserError, ValidationError
+from odoo.tools.misc import str2bool
 
 
 class StockIpv(models.Model):
@@ -12,6 +22,9 @@ class StockIpv(models.Model):
 
     name = fields.Char(required=True, copy=False, default='New')
 
+    active = fields.Boolean(default=True, index=True,
+                            help='Closed turns are archived, their lines are compacted into the summary.')
+
     requested_by = fields.Many2one(
         'res.users', 'Requested by', required=True,
         default=lambda s: s.env.uid, readonly=True
@@ -30,13 +43,15 @@ class StockIpv(models.Model):
         ('draft', 'Draft'),
         ('check', 'Check'),
         ('ready', 'Ready'),
+        ('opening', 'Opening'),
         ('open', 'Open'),
         ('close', 'Close'),
         ('cancel', 'Cancelled'),
     ], string='Status', compute='_compute_state', default='draft',
-        copy=False, index=True, readonly=True, store=False, track_visibility='onchange',
+        copy=False, index=True, readonly=True, store=True, track_visibility='onchange',
         help=" * Draft: No ha sido confirmado.\n"
              " * Ready: Chequeado disponibilidad y reservada las cantidades, listo para ser abierto.\n"
+             " * Opening: La apertura se esta procesando en segundo plano.\n"
              " * Open: Las cantidades han sido movidas, no hay retorno, se puede agregar mas cantidades y productos.\n"
              " * Close: Esta bloqueado y no se puede editar mas.\n")
 
@@ -60,12 +75,27 @@ class StockIpv(models.Model):
     date_close = fields.Datetime('Close date', copy=False, readonly=True,
                                  help="Date at which the turn was closed.")
 
-    @api.depends('procurement_group_id')
+    queue_ids = fields.One2many('stock.ipv.queue', 'ipv_id', string='Background Jobs')
+    queue_progress = fields.Float('Progress', compute='_compute_queue_progress')
+
+    summary_ids = fields.One2many('stock.ipv.summary', 'ipv_id', string='Summary', readonly=True)
+
+    pos_sale_ids = fields.One2many('stock.ipv.pos.sale', 'ipv_id', string='POS Sales')
+    pos_order_ids = fields.Many2many('pos.order', 'stock_ipv_pos_order_rel', 'ipv_id', 'order_id',
+                                     string='Counted POS Orders', copy=False, readonly=True,
+                                     help='POS orders already added to the sold quantities.')
+
+    error_message = fields.Text('Last Error', copy=False, readonly=True,
+                                help="Error of the last mass open or close of this turn.")
+
+    @api.depends('picking_ids')
     def _compute_picking_ids(self):
+        # Los pickings sin movidas no se cuentan, el cron _sweep_empty_ipv_pickings los elimina
+        groups = self.env['stock.picking'].read_group(
+            [('ipv_id', 'in', self.filtered('id').ids), ('move_lines', '!=', False)], ['ipv_id'], ['ipv_id'])
+        counts = {group['ipv_id'][0]: group['ipv_id_count'] for group in groups}
         for ipv in self:
-            # Clean here because can be pick without move
-            self.picking_ids.filtered(lambda p: not p.move_lines).unlink()
-            ipv.num_pickings = len(ipv.picking_ids)
+            ipv.num_pickings = counts.get(ipv.id, 0)
 
     def action_view_ipv_pickings(self):
         self.ensure_one()
@@ -80,17 +110,181 @@ class StockIpv(models.Model):
 
     @api.onchange('workplace_id')
     def _compute_child_lines(self):
-        last_ipv = self.search([('workplace_id', '=', self.workplace_id.id), ('state', '=', 'close')], limit=1)
         list = []
-        for ipvl in last_ipv.saleable_lines.filtered(lambda ipvl: ipvl.on_hand_qty != 0.0):
+        for line in self.get_carry_over_lines(self.workplace_id.id):
             data = {
-                'product_id': ipvl.product_id.id,
-                'bom_id': ipvl.bom_id.id,
+                'product_id': line['product_id'],
+                'bom_id': line['bom_id'],
             }
             list.append((0, 0, data))
         self.saleable_lines = list
 
-    @api.depends('picking_ids.state')
+    @api.model
+    def get_carry_over_lines(self, workplace_id):
+        """Saleable lines of the last closed turn of the workplace that still have stock in its sales area.
+
+        The quantities of all the lines are read with a single grouped quant query.
+
+        :return: list of dicts with product_id, bom_id and on_hand_qty
+        """
+        workplace = self.env['ipv.work.place'].browse(workplace_id)
+        if not workplace:
+            return []
+        last_ipv = self.search([('workplace_id', '=', workplace.id), ('state', '=', 'close')],
+                               order='date_close desc, id desc', limit=1)
+        lines = last_ipv.saleable_lines
+        quantities = self.env['stock.quant']._get_ipv_quantities(workplace.sales_loc, lines.mapped('product_id'))
+        result = []
+        for ipvl in lines:
+            qty = quantities.get(ipvl.product_id.id, 0.0)
+            if float_is_zero(qty, precision_rounding=ipvl.product_uom.rounding):
+                continue
+            result.append({
+                'product_id': ipvl.product_id.id,
+                'bom_id': ipvl.bom_id.id,
+                'on_hand_qty': qty,
+            })
+        return result
+
+    @api.multi
+    def set_demand(self, demand, batch_size=None):
+        """Apply a whole demand sheet to the saleable lines of the IPV in one call.
+
+        Only the lines whose demand changes are written and the new products are created in one batch, or
+        in batches of ``batch_size`` lines.
+
+        :param demand: dict {product_id: qty}
+        :return: the saleable lines with their demand and stock quantities
+        """
+        self.ensure_one()
+        if self.state in ['opening', 'close', 'cancel']:
+            raise UserError('No se puede modificar la demanda de un IPV en estado %s.' % self.state)
+        demand = self._check_demand(demand)
+        lines_by_product = {ipvl.product_id.id: ipvl for ipvl in self.saleable_lines}
+        IpvLine = self.env['stock.ipv.line']
+        vals_list = []
+        new_qties = {}
+        for product, qty in demand.items():
+            ipvl = lines_by_product.get(product.id)
+            if not ipvl:
+                vals_list.append({
+                    'ipv_id': self.id,
+                    'product_id': product.id,
+                    'bom_id': IpvLine._get_default_bom(product).id,
+                    'request_qty': qty,
+                })
+            elif float_compare(ipvl.request_qty, qty, precision_rounding=ipvl.product_uom.rounding):
+                new_qties[ipvl] = qty
+        IpvLine.set_request_qty(new_qties)
+        batch_size = batch_size or len(vals_list)
+        for index in range(0, len(vals_list), batch_size or 1):
+            IpvLine.create(vals_list[index:index + batch_size])
+        return self.saleable_lines.read(['product_id', 'product_uom', 'request_qty', 'initial_stock_qty',
+                                         'on_hand_qty', 'consumed_qty', 'state'])
+
+    def _check_demand(self, demand):
+        """Validate a demand sheet against the catalogue of the workplace.
+
+        :param demand: dict {product_id: qty}, the keys may come as text from JSON
+        :return: dict {product: qty}
+        :raise UserError: listing every entry with an unknown product, a product not saleable in the
+            workplace or a negative or non numeric quantity
+        """
+        catalogue = set(self.workplace_id.catalogue_product_ids.ids)
+        errors = []
+        result = {}
+        for product_id, qty in demand.items():
+            try:
+                product_id = int(product_id)
+            except (TypeError, ValueError):
+                errors.append('%s: producto desconocido' % product_id)
+                continue
+            if product_id not in catalogue:
+                errors.append('%s: el producto no se vende en %s' % (product_id, self.workplace_id.name))
+                continue
+            try:
+                qty = float(qty)
+            except (TypeError, ValueError):
+                errors.append('%s: la cantidad %s no es un numero' % (product_id, qty))
+                continue
+            if qty < 0.0:
+                errors.append('%s: la cantidad no puede ser negativa' % product_id)
+                continue
+            result[self.env['product.product'].browse(product_id)] = qty
+        if errors:
+            raise UserError('La demanda tiene entradas incorrectas:\n%s' % '\n'.join(errors))
+        return result
+
+    @api.one
+    def action_suggest_demand(self):
+        """Set the demand of the saleable lines from the consumption of the last closed turns.
+
+        The consumption of the last N closed turns of the workplace on the same weekday is read with one
+        grouped query and smoothed exponentially (newest turns weigh more), the current stock is then
+        subtracted. Writing the demand explodes it into the raw lines as usual.
+        """
+        lines = self.saleable_lines
+        if not lines:
+            return
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        turns = int(get_param('stock_ipv.suggest_turns', 8))
+        alpha = float(get_param('stock_ipv.suggest_alpha', 0.5))
+        # El dia de la semana en la zona horaria del usuario, un turno de noche no cae en el dia siguiente
+        tz = self.env.user.tz or self.env.user.company_id.partner_id.tz or 'UTC'
+        now = pytz.utc.localize(fields.Datetime.now()).astimezone(pytz.timezone(tz))
+        # dow de PostgreSQL: domingo es 0
+        weekday = (now.weekday() + 1) % 7
+        product_ids = lines.mapped('product_id').ids
+
+        self.env.cr.execute("""
+            SELECT l.ipv_id, ipv.date_close, l.product_id,
+                   SUM(COALESCE(l.initial_stock_qty, 0.0) + COALESCE(l.request_qty, 0.0)
+                       - COALESCE(l.final_stock_qty, 0.0))
+              FROM stock_ipv_line l
+              JOIN stock_ipv ipv ON ipv.id = l.ipv_id
+             WHERE l.ipv_id IN (SELECT id
+                                  FROM stock_ipv
+                                 WHERE workplace_id = %s
+                                   AND state = 'close'
+                                   AND EXTRACT(dow FROM date_open AT TIME ZONE 'UTC' AT TIME ZONE %s) = %s
+                              ORDER BY date_close DESC
+                                 LIMIT %s)
+               AND NOT COALESCE(l.is_raw, FALSE)
+               AND l.product_id IN %s
+          GROUP BY l.ipv_id, ipv.date_close, l.product_id
+        """, (self.workplace_id.id, tz, weekday, turns, tuple(product_ids)))
+        rows = self.env.cr.fetchall()
+        if not rows:
+            return
+
+        # Consumo por producto y turno, los turnos ordenados del mas viejo al mas reciente
+        ipv_ids = [ipv_id for ipv_id, date_close in sorted({(row[0], row[1]) for row in rows},
+                                                           key=lambda turn: turn[1])]
+        weights = {ipv_id: alpha * (1.0 - alpha) ** (len(ipv_ids) - 1 - index)
+                   for index, ipv_id in enumerate(ipv_ids)}
+        total_weight = sum(weights.values())
+        forecast = defaultdict(float)
+        for ipv_id, date_close, product_id, qty in rows:
+            forecast[product_id] += qty * weights[ipv_id] / total_weight
+        on_hand = defaultdict(float)
+        for ipvl in lines:
+            on_hand[ipvl.product_id.id] += ipvl.on_hand_qty
+
+        new_qties = {}
+        for ipvl in lines:
+            product_id = ipvl.product_id.id
+            qty = float_round(max(forecast[product_id] - on_hand[product_id], 0.0),
+                              precision_rounding=ipvl.product_uom.rounding, rounding_method='UP')
+            if float_compare(qty, ipvl.request_qty, precision_rounding=ipvl.product_uom.rounding):
+                new_qties[ipvl] = qty
+        self.env['stock.ipv.line'].set_request_qty(new_qties)
+
+    @api.depends('queue_ids.progress')
+    def _compute_queue_progress(self):
+        for ipv in self:
+            ipv.queue_progress = ipv.queue_ids[-1:].progress
+
+    @api.depends('date_open', 'date_close', 'ipv_lines', 'picking_ids.state', 'queue_ids.state')
     def _compute_state(self):
         ''' State of a picking depends on the state of its related stock.move
         - Draft: only used for "planned pickings"
@@ -102,12 +296,17 @@ class StockIpv(models.Model):
           - (a) all quantities are reserved or if
           - (b) some quantities could be reserved and the shipping policy is "as soon as possible"
         - Done: if the picking is done.
-        - Cancelled: if the picking is cancelled '''
+        - Cancelled: if the picking is cancelled
+        Open and Close come from the turn dates so the stored value survives recomputation. '''
 
         for ipv in self:
-            if ipv.state in ['open', 'close']:
-                return
-            if not ipv.saleable_lines:
+            if ipv.date_close:
+                ipv.state = 'close'
+            elif ipv.date_open:
+                ipv.state = 'open'
+            elif any(job.state in ['pending', 'running'] for job in ipv.queue_ids):
+                ipv.state = 'opening'
+            elif not ipv.saleable_lines:
                 ipv.state = 'draft'
             elif all(pick.state == 'draft' for pick in ipv.picking_ids):
                 ipv.state = 'draft'
@@ -118,7 +317,7 @@ class StockIpv(models.Model):
             else:
                 ipv.state = 'check'
 
-    @api.depends('saleable_lines.request_qty', 'picking_ids.show_check_availability', 'state')
+    @api.depends('saleable_lines.request_qty', 'ipv_lines.pending_qty', 'picking_ids.show_check_availability', 'state')
     def _compute_show_check_availability(self):
         self.ensure_one()
 
@@ -126,7 +325,9 @@ class StockIpv(models.Model):
 
         has_qty_to_reserve = any(float_compare(ipvl.request_qty, 0, precision_rounding=ipvl.product_uom.rounding)
                                  and ipvl.state not in ['assigned', 'done', 'cancel'] for ipvl in self.saleable_lines)
-        self.show_check_availability = has_qty_to_reserve or pick_check_availability
+        has_pending_qty = any(not float_is_zero(ipvl.pending_qty, precision_rounding=ipvl.product_uom.rounding)
+                              for ipvl in self.ipv_lines)
+        self.show_check_availability = has_qty_to_reserve or pick_check_availability or has_pending_qty
 
     @api.depends('picking_ids.show_validate')
     def _compute_show_validate(self):
@@ -157,46 +358,136 @@ class StockIpv(models.Model):
 
     @api.one
     def action_assign(self):
-        ipvl_todo = self.ipv_lines.filtered(lambda i: not i.has_moves and not i.is_manufactured)
-        moves = self._generate_moves(ipvl_todo)
-        # Reservar solo las movidas que vienen del almacen (MP y Merca)
-        self.picking_ids |= moves.mapped('picking_id')
-        self.picking_ids.filtered(lambda p: p.state not in ['done']).action_assign()
+        self._lock_quants(*self._get_lock_targets())
+        perf_log = self.env['stock.ipv.perf.log']
+        with perf_log._track(self, 'action_assign', self.ipv_lines):
+            self.ipv_lines._flush_pending_qty()
+            ipvl_todo = self.ipv_lines.filtered(lambda i: not i.has_moves and not i.is_manufactured)
+            moves = self._generate_moves(ipvl_todo)
+            # Reservar solo las movidas que vienen del almacen (MP y Merca)
+            self.picking_ids |= moves.mapped('picking_id')
+            pickings = self.picking_ids.filtered(lambda p: p.state not in ['done'])
+            with perf_log._track(self, 'reserve', pickings):
+                pickings.action_assign()
         return True
 
     def _generate_moves(self, list_ipvl):
         workplace = self.workplace_id
         stock = workplace.stock_loc
-        sales = workplace.sales_loc
+        picking_type = self.env.ref('stock_ipv.ipv_picking_type')
+        warehouse = stock.get_warehouse()
+        move_vals = []
         # Solo crear movidas para los que se solicita una cantidad
         for ipvl in list_ipvl.filtered('request_qty'):
             elaboration = ipvl.elaboration_loc or workplace.elaboration_loc
-            data = {
+            move_vals.append({
                 # 'sequence': bom_line.sequence,
                 'name': self.name,
                 # 'bom_line_id': bom_line.id,
-                'picking_type_id': self.env.ref('stock_ipv.ipv_picking_type').id,
+                'ipvl_id': ipvl.id,
+                'picking_type_id': picking_type.id,
                 'product_id': ipvl.product_id.id,
                 'product_uom_qty': ipvl.request_qty,
                 'product_uom': ipvl.product_uom.id,
                 'location_id': elaboration.id if ipvl.is_manufactured else stock.id,
-                'location_dest_id': elaboration.id if ipvl.is_raw else sales.id,
+                'location_dest_id': ipvl._get_dest_loc().id,
                 # 'procure_method': 'make_to_stock',
                 'origin': self.name,
-                'warehouse_id': stock.get_warehouse().id,
+                'warehouse_id': warehouse.id,
                 'group_id': self.procurement_group_id.id,
-            }
-            ipvl.move_ids = self.env['stock.move'].create(data)
-        moves = list_ipvl.mapped('move_ids')._action_confirm()
+            })
+        if not move_vals:
+            return self.env['stock.move']
+        # Una sola creacion y confirmacion para todas las lineas
+        perf_log = self.env['stock.ipv.perf.log']
+        with perf_log._track(self, 'generate_moves', move_vals):
+            moves = self.env['stock.move'].create(move_vals)
+        with perf_log._track(self, 'action_confirm', moves):
+            moves = moves._action_confirm()
         return moves
 
     @api.one
     def action_validate(self):
-        for ipvl in self.ipv_lines:
-            ipvl.initial_stock_qty = ipvl.on_hand_qty
+        if self.env['stock.ipv.queue']._is_enabled():
+            self._enqueue('validate')
+            return
+        self._prepare_validate()
+        with self.env['stock.ipv.perf.log']._track(self, 'action_done', self.picking_ids):
+            self.picking_ids.action_done()
+
+    def _prepare_validate(self):
+        """Everything action_validate does before action_done: store the initial stock, generate the moves
+        of manufactured products and set the done quantities.
+
+        It can run again on a retried background job, the initial stock is only taken for the lines whose
+        moves are not done yet, the stock of the others has already moved."""
+        self.ensure_one()
+        self._lock_quants(*self._get_lock_targets())
+        self.ipv_lines._flush_pending_qty()
+        self.ipv_lines.filtered(lambda l: not any(move.state == 'done' for move in l.move_ids))\
+            ._store_on_hand_qty('initial_stock_qty')
         # Generate moves for manufactured products
-        manufactured_moves = self._generate_moves(self.ipv_lines.filtered('is_manufactured'))
+        manufactured_moves = self._generate_moves(self.ipv_lines.filtered(lambda i: i.is_manufactured
+                                                                          and not i.has_moves))
         self.picking_ids |= manufactured_moves.mapped('picking_id')
+        with self.env['stock.ipv.perf.log']._track(self, 'set_quantity_done', self.picking_ids):
+            self._set_quantities_done()
+
+    def _get_lock_targets(self):
+        """Products of the lines and every location their moves come from or go to.
+
+        :return: tuple (products, locations)
+        """
+        lines = self.mapped('ipv_lines')
+        workplaces = self.mapped('workplace_id')
+        locations = workplaces.mapped('stock_loc') | workplaces.mapped('sales_loc') | \
+            workplaces.mapped('elaboration_loc') | lines.mapped('elaboration_loc')
+        return lines.mapped('product_id'), locations
+
+    def _lock_quants(self, products, locations):
+        """Lock the quants of ``products`` in ``locations`` before any reservation work
+        (stock_ipv.lock_reservation).
+
+        The quants are locked with a blocking FOR UPDATE ordered by product and location, so turns sharing a
+        stock location take them in the same order and wait for each other instead of deadlocking. The wait
+        is bounded by a lock_timeout and retried with exponential backoff up to stock_ipv.lock_retries times.
+        The context keys ipv_lock_reservation, ipv_lock_retries and ipv_lock_timeout override the parameters.
+        """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        context = self.env.context
+        if not context.get('ipv_lock_reservation', str2bool(get_param('stock_ipv.lock_reservation', 'False'))):
+            return
+        if not products or not locations:
+            return
+        locations = self.env['stock.location'].search([('id', 'child_of', locations.ids)])
+        query = """
+            SELECT id
+              FROM stock_quant
+             WHERE product_id IN %s
+               AND location_id IN %s
+          ORDER BY product_id, location_id, id
+               FOR UPDATE
+        """
+        params = (tuple(products.ids), tuple(locations.ids))
+        attempts = int(context.get('ipv_lock_retries') or get_param('stock_ipv.lock_retries', 5))
+        timeout = int(context.get('ipv_lock_timeout') or get_param('stock_ipv.lock_timeout', 2000))
+        cr = self.env.cr
+        with self.env['stock.ipv.perf.log']._track(self[:1], 'lock', products) as stats:
+            stats['retry_count'] = 0
+            for attempt in range(attempts):
+                try:
+                    with cr.savepoint():
+                        cr.execute('SET LOCAL lock_timeout = %s', (timeout,))
+                        cr.execute(query, params)
+                    break
+                except OperationalError as e:
+                    if e.pgcode != errorcodes.LOCK_NOT_AVAILABLE or attempt == attempts - 1:
+                        raise
+                    stats['retry_count'] += 1
+                    time.sleep(random.uniform(0.0, 0.05 * 2 ** attempt))
+            cr.execute('SET LOCAL lock_timeout = DEFAULT')
+
+    def _set_quantities_done(self):
         for pick in self.picking_ids:
             picking_type = pick.picking_type_id
             precision_digits = self.env['decimal.precision'].precision_get('Product Unit of Measure')
@@ -210,22 +501,230 @@ class StockIpv(models.Model):
                     qty = move.product_uom_qty
                     move._set_quantity_done(qty)
 
-        self.picking_ids.action_done()
+    def _enqueue(self, action):
+        """Leave the action to the background worker, the IPV stays in Opening until it is done."""
+        self.ensure_one()
+        if not any(job.state in ['pending', 'running'] for job in self.queue_ids):
+            self.env['stock.ipv.queue'].create({'ipv_id': self.id, 'action': action})
+        self.error_message = False
 
     @api.one
     def button_open(self):
+        if self.env['stock.ipv.queue']._is_enabled():
+            self._enqueue('open')
+            return True
         self.action_validate()
         if all(pick.state == 'done' for pick in self.picking_ids):
-            self.write({
-                'state': 'open',
-                'date_open': fields.Datetime.now()})
+            self.write({'date_open': fields.Datetime.now(), 'error_message': False})
         return True
 
-    @api.one
+    @api.multi
+    def _update_pos_sales(self):
+        """Add the paid POS orders not counted yet to the sold quantities of the open IPVs.
+
+        The counted orders are recorded in stock_ipv_pos_order_rel by the same statement that upserts the
+        sold quantities, so an order paid late is still counted once and the IPV row itself is not written."""
+        for ipv in self.filtered(lambda i: i.state == 'open'):
+            self.env.cr.execute("""
+                WITH new_orders AS (
+                    INSERT INTO stock_ipv_pos_order_rel (ipv_id, order_id)
+                    SELECT %(ipv)s, o.id
+                      FROM pos_order o
+                     WHERE o.location_id = %(location)s
+                       AND o.state IN ('paid', 'done', 'invoiced')
+                       AND o.date_order >= %(date_open)s
+                       AND NOT EXISTS (SELECT 1
+                                         FROM stock_ipv_pos_order_rel r
+                                        WHERE r.ipv_id = %(ipv)s
+                                          AND r.order_id = o.id)
+                        ON CONFLICT DO NOTHING
+                 RETURNING order_id
+                )
+                INSERT INTO stock_ipv_pos_sale (ipv_id, product_id, sold_qty, consumed_qty, difference_qty,
+                                                create_uid, create_date, write_uid, write_date)
+                SELECT %(ipv)s, l.product_id, SUM(l.qty), 0.0, 0.0,
+                       %(uid)s, NOW() AT TIME ZONE 'UTC', %(uid)s, NOW() AT TIME ZONE 'UTC'
+                  FROM pos_order_line l
+                  JOIN new_orders o ON o.order_id = l.order_id
+              GROUP BY l.product_id
+                    ON CONFLICT (ipv_id, product_id)
+                    DO UPDATE SET sold_qty = stock_ipv_pos_sale.sold_qty + EXCLUDED.sold_qty,
+                                  write_date = EXCLUDED.write_date
+            """, {
+                'location': ipv.workplace_id.sales_loc.id,
+                'date_open': ipv.date_open,
+                'ipv': ipv.id,
+                'uid': self.env.uid,
+            })
+        self.invalidate_cache(['pos_order_ids'])
+        self.env['stock.ipv.pos.sale'].invalidate_cache()
+
+    @api.multi
+    def _reconcile_pos_sales(self):
+        """Compare the POS sold quantities with the stock consumption of the turns in aggregated queries.
+
+        Products of the IPV not sold get a row with no sales, and products sold but missing from the IPV
+        keep their row with no consumption, the difference is recomputed for all of them."""
+        if not self:
+            return
+        self.env.cr.execute("""
+            INSERT INTO stock_ipv_pos_sale (ipv_id, product_id, sold_qty, consumed_qty, difference_qty,
+                                            create_uid, create_date, write_uid, write_date)
+            SELECT ipv_id, product_id, 0.0, qty, 0.0,
+                   %(uid)s, NOW() AT TIME ZONE 'UTC', %(uid)s, NOW() AT TIME ZONE 'UTC'
+              FROM (SELECT ipv_id, product_id,
+                           SUM(COALESCE(initial_stock_qty, 0.0) + COALESCE(request_qty, 0.0)
+                               - COALESCE(final_stock_qty, 0.0)) AS qty
+                      FROM stock_ipv_line
+                     WHERE ipv_id IN %(ipvs)s
+                       AND NOT COALESCE(is_raw, FALSE)
+                  GROUP BY ipv_id, product_id) consumed
+                ON CONFLICT (ipv_id, product_id)
+                DO UPDATE SET consumed_qty = EXCLUDED.consumed_qty,
+                              write_date = EXCLUDED.write_date
+        """, {'ipvs': tuple(self.ids), 'uid': self.env.uid})
+        self.env.cr.execute("""
+            UPDATE stock_ipv_pos_sale
+               SET difference_qty = consumed_qty - sold_qty
+             WHERE ipv_id IN %s
+        """, (tuple(self.ids),))
+        self.env['stock.ipv.pos.sale'].invalidate_cache()
+
+    def _get_pending_ipvs(self):
+        """IPVs in self with demand added after the last Check Availability, not moved yet."""
+        return self.filtered(lambda ipv: any(
+            not float_is_zero(ipvl.pending_qty, precision_rounding=ipvl.product_uom.rounding)
+            for ipvl in ipv.ipv_lines))
+
+    @api.multi
     def button_close(self):
-        self.write({'state': 'close', 'date_close': fields.Datetime.now()})
+        pending = self._get_pending_ipvs()
+        if pending:
+            raise UserError('Los IPV %s tienen demanda pendiente de mover, compruebe la disponibilidad y '
+                            'valide antes de cerrar.' % ', '.join(pending.mapped('name')))
+        self._update_pos_sales()
+        # Un cierre masivo se registra sin IPV
+        ipv = self if len(self) == 1 else self.browse()
+        with self.env['stock.ipv.perf.log']._track(ipv, 'close', self.mapped('ipv_lines')):
+            self.mapped('ipv_lines')._store_on_hand_qty('final_stock_qty')
+        self.write({'date_close': fields.Datetime.now(), 'error_message': False})
+        self._reconcile_pos_sales()
         return True
 
+    @api.model
+    def _archive_closed_ipvs(self):
+        """Cron: compact the IPVs closed more than stock_ipv.archive_days ago, committing per chunk."""
+        days = int(self.env['ir.config_parameter'].sudo().get_param('stock_ipv.archive_days', 365))
+        ipvs = self.search([('state', '=', 'close'), ('date_close', '<', fields.Datetime.now() - timedelta(days=days))])
+        for index in range(0, len(ipvs), 100):
+            ipvs[index:index + 100]._archive_lines()
+            self.env.cr.commit()
+        if ipvs:
+            self.env['report.stock.ipv.consumption']._refresh_view()
+
+    @api.multi
+    def _archive_lines(self):
+        """Roll the lines of closed IPVs into stock.ipv.summary and drop them, then archive the IPVs.
+
+        The moves are detached before, deleting the lines through the ORM would cancel them."""
+        ipv_ids = tuple(self.filtered(lambda i: i.state == 'close').ids)
+        if not ipv_ids:
+            return
+        cr = self.env.cr
+        cr.execute("""
+            INSERT INTO stock_ipv_summary (ipv_id, workplace_id, product_id, is_raw, date_close,
+                                           initial_stock_qty, request_qty, final_stock_qty, consumed_qty,
+                                           create_uid, create_date, write_uid, write_date)
+            SELECT ipv.id, ipv.workplace_id, l.product_id, COALESCE(l.is_raw, FALSE), ipv.date_close,
+                   SUM(COALESCE(l.initial_stock_qty, 0.0)),
+                   SUM(COALESCE(l.request_qty, 0.0)),
+                   SUM(COALESCE(l.final_stock_qty, 0.0)),
+                   SUM(COALESCE(l.initial_stock_qty, 0.0) + COALESCE(l.request_qty, 0.0)
+                       - COALESCE(l.final_stock_qty, 0.0)),
+                   %(uid)s, NOW() AT TIME ZONE 'UTC', %(uid)s, NOW() AT TIME ZONE 'UTC'
+              FROM stock_ipv_line l
+              JOIN stock_ipv ipv ON ipv.id = l.ipv_id
+             WHERE ipv.id IN %(ipvs)s
+          GROUP BY ipv.id, ipv.workplace_id, ipv.date_close, l.product_id, COALESCE(l.is_raw, FALSE)
+        """, {'ipvs': ipv_ids, 'uid': self.env.uid})
+        cr.execute("""
+            UPDATE stock_move SET ipvl_id = NULL
+             WHERE ipvl_id IN (SELECT id FROM stock_ipv_line WHERE ipv_id IN %s)
+        """, (ipv_ids,))
+        # stock_ipv_product_raws_rel se borra en cascada
+        cr.execute('DELETE FROM stock_ipv_line WHERE ipv_id IN %s', (ipv_ids,))
+        self.invalidate_cache()
+        self.env['stock.ipv.line'].invalidate_cache()
+        self.env['stock.move'].invalidate_cache(['ipvl_id'])
+        self.browse(ipv_ids).write({'active': False})
+
+    @api.multi
+    def action_mass_open(self):
+        """Open all the IPVs in self at once (shift change).
+
+        The pickings of every IPV are merged by picking type and locations and each group is
+        processed with a single action_done, all inside one savepoint. When any IPV fails the whole
+        batch is rolled back and the IPVs are opened one by one, each in its own savepoint covering
+        its _prepare_validate and action_done, so a failing IPV is left as it was, gets its
+        error_message set and does not prevent the others from opening.
+
+        :return: an action listing the failed IPVs, or False when all of them were opened
+        """
+        to_open = self.filtered(lambda i: i.state == 'ready')
+        failures = {ipv: 'El IPV no esta listo para ser abierto.' for ipv in self - to_open}
+
+        def picking_key(pick):
+            return pick.picking_type_id.id, pick.location_id.id, pick.location_dest_id.id
+
+        try:
+            with self.env.cr.savepoint():
+                for ipv in to_open:
+                    ipv._prepare_validate()
+                pickings = to_open.mapped('picking_ids').filtered(lambda p: p.state != 'done')
+                for key, picks in groupby(pickings.sorted(key=picking_key), key=picking_key):
+                    self.env['stock.picking'].concat(*picks).action_done()
+            opened = to_open
+        except (UserError, ValidationError):
+            # Uno de los IPV falla, abrirlos por separado para aislarlo
+            self.env.clear()
+            opened = self.browse()
+            for ipv in to_open:
+                try:
+                    with self.env.cr.savepoint():
+                        ipv._prepare_validate()
+                        ipv.picking_ids.filtered(lambda p: p.state != 'done').action_done()
+                    opened |= ipv
+                except (UserError, ValidationError) as e:
+                    self.env.clear()
+                    failures[ipv] = e.name
+
+        opened = opened.filtered(lambda i: all(pick.state == 'done' for pick in i.picking_ids))
+        opened.write({'date_open': fields.Datetime.now(), 'error_message': False})
+        return self._mass_action_result(failures)
+
+    @api.multi
+    def action_mass_close(self):
+        """Close all the open IPVs in self with a single write.
+
+        :return: an action listing the IPVs that could not be closed, or False
+        """
+        to_close = self.filtered(lambda i: i.state == 'open')
+        failures = {ipv: 'Solo se puede cerrar un IPV abierto.' for ipv in self - to_close}
+        pending = to_close._get_pending_ipvs()
+        failures.update({ipv: 'Tiene demanda pendiente de mover, compruebe la disponibilidad y valide antes '
+                              'de cerrar.' for ipv in pending})
+        (to_close - pending).button_close()
+        return self._mass_action_result(failures)
+
+    def _mass_action_result(self, failures):
+        for ipv, message in failures.items():
+            ipv.error_message = message
+        if not failures:
+            return False
+        action = self.env.ref('stock_ipv.action_stock_ipv').read()[0]
+        action['domain'] = [('id', 'in', [ipv.id for ipv in failures])]
+        return action
+
     @api.one
     def action_cancel(self):
         self.picking_ids.action_cancel()
@@ -1,11 +1,13 @@
 
-from itertools import groupby
-from operator import itemgetter
+from collections import defaultdict
 
-from odoo import models, fields, api
-from odoo.tools.float_utils import float_compare, float_is_zero, float_round
+from odoo import models, fields, api, _
+from odoo.tools.float_utils import float_is_zero, float_round
 from odoo.exceptions import UserError
 
+# Niveles maximos de una receta, protege de listas de materiales recursivas
+MAX_BOM_DEPTH = 20
+
 
 class StockIpvLine(models.Model):
     _name = 'stock.ipv.line'
@@ -17,9 +19,12 @@ class StockIpvLine(models.Model):
                                  domain=[('type', 'in', ['product']), ('available_in_pos', '=', True),
                                          ],
                                  )
-    elaboration_loc = fields.Many2one('stock.location', related='product_id.elaboration_loc')
+    elaboration_loc = fields.Many2one('stock.location', 'Elaboration Area', index=True,
+                                      domain=[('usage', 'in', ['internal'])],
+                                      help='Area where the product is elaborated, for raw materials the area where '
+                                           'the products they are used in are elaborated.')
 
-    is_manufactured = fields.Integer(related='product_id.bom_count')
+    is_manufactured = fields.Boolean('Is Manufactured', compute='_compute_is_manufactured', store=True, index=True)
 
     is_raw = fields.Boolean(string='Is Raw Material')
 
@@ -40,7 +45,7 @@ class StockIpvLine(models.Model):
         ('partially_available', 'Partially Available'),
         ('assigned', 'Available'),
         ('done', 'Done')], string='Status',
-        copy=False, compute='_compute_state', store=False, default='draft', index=True, readonly=True,
+        copy=False, compute='_compute_state', store=True, default='draft', index=True, readonly=True,
         help="* New: When the stock move is created and not yet confirmed.\n"
              "* Waiting Another Move: This state can be seen when a move is waiting for another one, for example in a chained flow.\n"
              "* Waiting Availability: This state is reached when the procurement resolution is not straight forward. It may need the scheduler to run, a component to be manufactured...\n"
@@ -59,11 +64,18 @@ class StockIpvLine(models.Model):
 
     initial_stock_qty = fields.Float('Initial Stock', readonly=True, copy=False)
 
+    final_stock_qty = fields.Float('Final Stock', readonly=True, copy=False,
+                                   help='Cantidad a mano al cerrar el turno')
+
     on_hand_qty = fields.Float('On Hand', compute='_compute_on_hand_qty', readonly=False,
                                help='Cantidad Disponible, En estado draft puede entrar la cantidad que desea tener')
 
     request_qty = fields.Float(string='Demand', help='Cantidad que desea mover al area de ventas')
 
+    pending_qty = fields.Float('Pending Demand', readonly=True, copy=False,
+                               help='Change of demand not moved yet, it is moved as a single move on the next '
+                                    'Check Availability or Validate.')
+
     consumed_qty = fields.Float('Consumed', compute='_compute_consumed_qty', copy=False)
 
     @api.multi
@@ -83,38 +95,85 @@ class StockIpvLine(models.Model):
         if not self.product_id:
             self.bom_id = False
             result = {}
-            if self.ipv_id.workplace_id:
-                result['domain'] = {'product_id': ['|', '&', '&', '&', ('type', 'in', ['product']), ('available_in_pos', '=', True),
-                                    ('id', 'not in', self.ipv_id.saleable_lines.mapped('product_id').ids),
-                                    ('workplace_ids', '=', False), ('product_tmpl_id', 'in', self.ipv_id.workplace_id.product_tmpl_ids.ids)]}
-            else:
+            # El dominio del catalogo del lugar de trabajo esta en la vista, ver ProductProduct._name_search
+            if not self.ipv_id.workplace_id:
                 result['warning'] = {'title': 'Work Place not Set',
                                      'message': 'Please select The Work Place'}
 
             return result
-        elif self.product_id.bom_count:
-            bom = self.env['mrp.bom']._bom_find(product=self.product_id)
-            if bom.type == 'normal':
-                self.bom_id = bom.id
-            else:
-                self.bom_id = False
         else:
-            self.bom_id = False
+            self.bom_id = self._get_default_bom(self.product_id)
+            self.elaboration_loc = self.product_id.elaboration_loc
+
+    @api.model
+    def _get_default_bom(self, product):
+        """BoM used by default when ``product`` is added to an IPV, only normal BoMs are exploded."""
+        if not product:
+            return self.env['mrp.bom']
+        bom_id, is_normal = self.env['mrp.bom']._ipv_get_product_bom(product.id)
+        return self.env['mrp.bom'].browse(bom_id if is_normal else [])
+
+    @api.depends('product_id')
+    def _compute_is_manufactured(self):
+        for ipvl in self:
+            ipvl.is_manufactured = bool(ipvl.product_id) and bool(
+                self.env['mrp.bom']._ipv_get_product_bom(ipvl.product_id.id)[0])
+
+    def _get_on_hand_location(self):
+        self.ensure_one()
+        if self.saleable_in_pos and not self.is_raw:
+            return self.ipv_id.workplace_id.sales_loc
+        elif self.is_raw:
+            return self._get_dest_loc()
+        elif self.elaboration_loc:
+            return self.elaboration_loc
+        return self.ipv_id.workplace_id.elaboration_loc
+
+    def _get_dest_loc(self):
+        """Location the product of the line is moved to: the sales area, or the elaboration area of the
+        products a raw material is used in."""
+        self.ensure_one()
+        workplace = self.ipv_id.workplace_id
+        if not self.is_raw:
+            return workplace.sales_loc
+        if self.is_manufactured and self.parent_ids:
+            # Los intermedios se elaboran en su area y se entregan en la de sus productos
+            return self.parent_ids[0].elaboration_loc or workplace.elaboration_loc
+        return self.elaboration_loc or workplace.elaboration_loc
+
+    def _get_raw_key(self):
+        return self.product_id.id, self._get_dest_loc().id
 
     @api.depends('product_id')
     def _compute_on_hand_qty(self):
         """Computa la cantidad de productos a mano en el area de venta, tiene que ser dependiente del contexto o
-        calcular como init_stock + request_qty - consumed?"""
-        for ipvl in self:
-            if ipvl.saleable_in_pos and not ipvl.is_raw:
-                location = ipvl.ipv_id.workplace_id.sales_loc
-            elif ipvl.elaboration_loc:
-                location = ipvl.elaboration_loc
-            else:
-                location = ipvl.ipv_id.workplace_id.elaboration_loc
+        calcular como init_stock + request_qty - consumed?
 
-            ipvl.on_hand_qty = ipvl.product_id.with_context(
-                    {'location': location.id}).qty_available
+        Lines are grouped by their location so each location costs a single quant query, lines of a
+        closed IPV are served from the quantity stored at close."""
+        lines_by_location = defaultdict(lambda: self.browse())
+        for ipvl in self:
+            if ipvl.ipv_id.state == 'close':
+                ipvl.on_hand_qty = ipvl.final_stock_qty
+                continue
+            lines_by_location[ipvl._get_on_hand_location()] |= ipvl
+        for location, lines in lines_by_location.items():
+            quantities = self.env['stock.quant']._get_ipv_quantities(location, lines.mapped('product_id'))
+            for ipvl in lines:
+                if not ipvl.product_id:
+                    ipvl.on_hand_qty = 0.0
+                    continue
+                ipvl.on_hand_qty = float_round(quantities.get(ipvl.product_id.id, 0.0),
+                                               precision_rounding=ipvl.product_uom.rounding)
+
+    def _store_on_hand_qty(self, fname):
+        """Copy the current on hand quantity into ``fname``, one write per distinct quantity."""
+        self.invalidate_cache(['on_hand_qty'], self.ids)
+        lines_by_qty = defaultdict(lambda: self.browse())
+        for ipvl in self:
+            lines_by_qty[ipvl.on_hand_qty] |= ipvl
+        for qty, lines in lines_by_qty.items():
+            lines.write({fname: qty})
 
     @api.depends('on_hand_qty')
     def _compute_consumed_qty(self):
@@ -132,7 +191,7 @@ class StockIpvLine(models.Model):
         for ipvl in self:
             ipvl.has_moves = bool(ipvl.move_ids)
 
-    @api.depends('raw_ids.state', 'move_ids.state')
+    @api.depends('product_id', 'is_manufactured', 'raw_ids.state', 'move_ids.state')
     def _compute_state(self):
         for ipvl in self:
             ''' State of a picking depends on the state of its related stock.move
@@ -166,17 +225,25 @@ class StockIpvLine(models.Model):
             else:
                 ipvl.state = ipvl.move_ids.state
 
-    @api.model
-    def create(self, vals):
-        res = super(StockIpvLine, self).create(vals)
-        if res.is_manufactured:
-            res.prepare_raw_materials()
+    @api.model_create_multi
+    def create(self, vals_list):
+        products = self.env['product.product'].browse([vals['product_id'] for vals in vals_list
+                                                       if vals.get('product_id') and 'elaboration_loc' not in vals])
+        for vals in vals_list:
+            if vals.get('product_id') and 'elaboration_loc' not in vals:
+                vals['elaboration_loc'] = products.browse(vals['product_id']).elaboration_loc.id
+        res = super(StockIpvLine, self).create(vals_list)
+        if not self.env.context.get('ipv_skip_raw_materials'):
+            res.filtered('is_manufactured').prepare_raw_materials()
         return res
 
+    @api.multi
     def unlink(self):
-        for ipvl in self.filtered('is_manufactured'):
-            ipvl.raw_ids.filtered(lambda r: len(r.parent_ids) == 1).unlink()
-            ipvl.update_request_qty()
+        manufactured = self.filtered('is_manufactured')
+        # Las materias primas exclusivas se borran con sus productos, a las compartidas se les descuenta la demanda
+        raws = manufactured.mapped('raw_ids') - self
+        raws.filtered(lambda r: not (r.parent_ids - manufactured)).unlink()
+        manufactured.update_request_qty()
         move_to_unlink = self.mapped('move_ids')
         # Pueden quedar picking sin movidas
         if move_to_unlink:
@@ -184,94 +251,224 @@ class StockIpvLine(models.Model):
             move_to_unlink.sudo().unlink()
         return super(StockIpvLine, self).unlink()
 
-    @api.model
+    @api.multi
     def write(self, vals):
-        if 'product_id' in vals and self.is_manufactured:
-            self.raw_ids.filtered(lambda r: len(r.parent_ids) == 1).unlink()
-            # Update Share Raws
-            if self.raw_ids:
-                self.update_request_qty()
-                self.raw_ids.update({'parent_ids': [(3, self.id)]})
-        elif 'request_qty' in vals:
-            qty = vals.get('request_qty')
-            self.update_request_qty(qty)
-        super(StockIpvLine, self).write(vals)
+        if 'product_id' in vals:
+            for ipvl in self.filtered('is_manufactured'):
+                ipvl.raw_ids.filtered(lambda r: len(r.parent_ids) == 1).unlink()
+                # Update Share Raws
+                if ipvl.raw_ids:
+                    ipvl.update_request_qty()
+                    ipvl.raw_ids.update({'parent_ids': [(3, ipvl.id)]})
+        elif 'request_qty' in vals and not self.env.context.get('ipv_request_qty_applied'):
+            self._update_request_qty({ipvl: vals['request_qty'] for ipvl in self})
+        res = super(StockIpvLine, self).write(vals)
         if vals.get('bom_id'):
             self.prepare_raw_materials()
+        return res
+
+    @api.model
+    def set_request_qty(self, new_qties):
+        """Write a different demand on each line with a single propagation pass.
+
+        :param new_qties: dict {line: new demand}
+        """
+        self._update_request_qty(new_qties)
+        lines_by_qty = defaultdict(lambda: self.browse())
+        for ipvl, qty in new_qties.items():
+            lines_by_qty[qty] |= ipvl
+        for qty, lines in lines_by_qty.items():
+            lines.with_context(ipv_request_qty_applied=True).write({'request_qty': qty})
+        return True
 
+    @api.multi
     def prepare_raw_materials(self):
-        info = {
-            'parent_ids': [(4, self.id)]
-        }
-        if self.request_qty:
-            raws, lines = self.explode_proportion(self.request_qty)
-            info['request_qty'] = 0.0
-        for boml in self.bom_id.bom_line_ids:
-            if 'request_qty' in info:
-                info['request_qty'] = raws.get(boml.product_id.name)
-            raw_existent = self.ipv_id.raw_lines.filtered(lambda r: r.product_id == boml.product_id
-                                                          and r.elaboration_loc == self.elaboration_loc)
-            if raw_existent:
-                if 'request_qty' in info:
-                    info['request_qty'] += raw_existent.request_qty
-                raw_existent.write(info)
-            else:
-                info.update({
-                    'ipv_id': self.ipv_id.id,
-                    'is_raw': True,
-                    'product_id': boml.product_id.id,
-                    'elaboration_loc': self.elaboration_loc.id,
-                })
-                self.env['stock.ipv.line'].create(info)
+        """Link the raw lines of the manufactured lines in self, creating the missing ones.
+
+        The BoM tree is walked once, level by level. Components with their own BoM become intermediate
+        manufactured lines elaborated in their own area, their raws are prepared on the next level. Raw lines
+        are found through a (product, destination area) index built once per IPV, new lines are created in
+        one batch per level and the demand of the existing ones is updated in a single pass at the end."""
+        Bom = self.env['mrp.bom']
+        for ipv in self.mapped('ipv_id'):
+            workplace = ipv.workplace_id
+            raw_index = {raw._get_raw_key(): raw for raw in ipv.raw_lines}
+            deltas = defaultdict(float)
+            level = [(ipvl, ipvl.request_qty) for ipvl in self if ipvl.ipv_id == ipv]
+            depth = 0
+            while level:
+                depth += 1
+                if depth > MAX_BOM_DEPTH:
+                    raise UserError(_('The bill of materials of %s is recursive or too deep.')
+                                    % ', '.join(self.mapped('product_id.display_name')))
+                parents = defaultdict(list)
+                request_qty = defaultdict(float)
+                for ipvl, qty in level:
+                    area = ipvl.elaboration_loc or workplace.elaboration_loc
+                    for product_id, raw_qty in ipvl.explode_proportion(qty).items():
+                        key = (product_id, area.id)
+                        parents[key].append(ipvl.id)
+                        request_qty[key] += raw_qty
+
+                level = []
+                vals_list = []
+                new_keys = []
+                for key, parent_ids in parents.items():
+                    raw_existent = raw_index.get(key)
+                    if raw_existent:
+                        missing = set(parent_ids) - set(raw_existent.parent_ids.ids)
+                        if missing:
+                            raw_existent.write({'parent_ids': [(4, parent_id) for parent_id in missing]})
+                        if request_qty[key]:
+                            # Los intermedios existentes propagan su demanda en _add_request_qty
+                            deltas[raw_existent] += request_qty[key]
+                        continue
+                    product_id, elaboration_loc_id = key
+                    bom_id, is_normal = Bom._ipv_get_product_bom(product_id)
+                    vals = {
+                        'ipv_id': ipv.id,
+                        'is_raw': True,
+                        'product_id': product_id,
+                        'elaboration_loc': elaboration_loc_id,
+                        'request_qty': request_qty[key],
+                        'parent_ids': [(4, parent_id) for parent_id in parent_ids],
+                    }
+                    if bom_id and is_normal:
+                        # Producto intermedio, se elabora en su propia area
+                        product = self.env['product.product'].browse(product_id)
+                        vals.update({'bom_id': bom_id, 'elaboration_loc': product.elaboration_loc.id})
+                    vals_list.append(vals)
+                    new_keys.append(key)
+                if vals_list:
+                    created = self.with_context(ipv_skip_raw_materials=True).create(vals_list)
+                    raw_index.update(zip(new_keys, created))
+                    level = [(raw, raw.request_qty) for raw in created.filtered('bom_id')]
+            if deltas:
+                self._add_request_qty(deltas)
         return True
 
     def explode_proportion(self, quantity=0.0):
-        # cantidad de veces que necesito la BoM
+        """Raw materials needed to make ``quantity`` of this line product, rounded up like explode does but
+        once for the whole quantity.
+
+        :return: dict {product_id: qty}
+        """
         bom = self.bom_id
-        raws = {}
-        factor = self.product_id.uom_id._compute_quantity(quantity, bom.product_uom_id) / bom.product_qty
-        boms, lines = bom.explode(self.product_id, factor)
-        for line in lines:
-            boml, data = line
-            raws[boml.product_id.name] = data['qty']
-        return raws, lines
+        if not bom:
+            return {}
+        # cantidad de veces que necesito la BoM
+        factor = self.product_id.uom_id._compute_quantity(quantity, bom.product_uom_id, round=False)
+        unit = bom._ipv_explode_unit(self.product_id.id)
+        products = self.env['product.product'].browse([product_id for product_id, qty in unit])
+        return {product.id: float_round(qty * factor, precision_rounding=product.uom_id.rounding,
+                                        rounding_method='UP')
+                for product, (product_id, qty) in zip(products, unit)}
 
+    @api.multi
     def update_request_qty(self, new_qty=0.0):
-        self.ensure_one()
-        ipv_id = self.ipv_id
-        workplace_id = ipv_id.workplace_id
-        dif_qty = new_qty - self.request_qty
-        if dif_qty < 0.0 and self.state == 'done':
-            raise UserError(_('You cannot reduce a qty that has been set to \'Done\'.'))
-        if self.is_manufactured:
-            old, lines = self.explode_proportion(self.request_qty)
-            new, lines = self.explode_proportion(new_qty)
-            for raw in self.raw_ids:
-                old_request_qty = old.get(raw.product_id.name)
-                new_request_qty = new.get(raw.product_id.name)
-                raw.update({'request_qty': raw.request_qty - old_request_qty + new_request_qty})
-        elif self.has_moves:
-            if self.is_raw:
-                dest_loc = self.elaboration_loc or workplace_id.elaboration_loc
-            else:
-                dest_loc = workplace_id.sales_loc
-
-            move = self.env['stock.move'].create({
-                'name': '%s(%s)' % (self.ipv_id.name, self.product_id.name),
-                'ipvl_id': self.id,
-                'picking_type_id': self.env.ref('stock_ipv.ipv_picking_type').id,
-                'product_id': self.product_id.id,
-                'product_uom_qty': dif_qty,
-                'product_uom': self.product_uom.id,
-                'location_id': ipv_id.workplace_id.stock_loc.id,
-                'location_dest_id': dest_loc.id,
-                # 'procure_method': 'make_to_stock',
-                'origin': ipv_id.name,
-                # 'warehouse_id': self.workplace_id.stock_loc.get_warehouse().id,
-                'group_id': ipv_id.procurement_group_id.id
-
-            })
-            move._action_confirm(merge_into=(self.move_ids - move))
+        return self._update_request_qty({ipvl: new_qty for ipvl in self})
+
+    def _update_request_qty(self, new_qties):
+        """Propagate a change of demand of several lines before it is written.
+
+        The demand in ``new_qties`` is final: a line in it does not also take the change propagated from
+        another line in it, so removing a product and its intermediate only takes their raws once.
+
+        :param new_qties: dict {line: new demand}
+        """
+        raw_deltas = self._propagate_request_qty(
+            {ipvl: new_qty - ipvl.request_qty for ipvl, new_qty in new_qties.items()}, skip=new_qties)
+        self._write_request_deltas(raw_deltas)
+        return True
+
+    def _add_request_qty(self, deltas):
+        """Add ``deltas`` to the demand of the lines and propagate them, every line written once.
+
+        :param deltas: dict {line: demand to add}
+        """
+        raw_deltas = self._propagate_request_qty(deltas)
+        for ipvl, delta in deltas.items():
+            raw_deltas[ipvl] += delta
+        self._write_request_deltas(raw_deltas)
         return True
 
+    def _propagate_request_qty(self, deltas, skip=()):
+        """Walk changes of demand down the whole tree of raw lines.
+
+        The raws of a manufactured line change by the difference between the rounded explosion of its demand
+        before and after the change, intermediate raws pass theirs to the next level. Lines that already have moves accumulate the difference in pending_qty, see
+        _flush_pending_qty. The lines in ``skip`` do not take propagated changes.
+
+        :param deltas: dict {line: change of demand}
+        :return: defaultdict {raw line: change of demand propagated to it}
+        """
+        raw_deltas = defaultdict(float)
+        pending = defaultdict(float)
+        # Demanda de cada linea manufacturada con los cambios ya propagados
+        current_qty = {}
+        todo = list(deltas.items())
+        while todo:
+            ipvl, dif_qty = todo.pop()
+            if not dif_qty:
+                continue
+            if dif_qty < 0.0 and ipvl.state == 'done':
+                raise UserError(_('You cannot reduce a qty that has been set to \'Done\'.'))
+            if ipvl.is_manufactured:
+                # Las cantidades se redondean, la diferencia se toma entre la demanda total antes y despues
+                old_qty = current_qty.get(ipvl, ipvl.request_qty)
+                current_qty[ipvl] = old_qty + dif_qty
+                old_raws = ipvl.explode_proportion(old_qty)
+                new_raws = ipvl.explode_proportion(old_qty + dif_qty)
+                for raw in ipvl.raw_ids:
+                    raw_qty = new_raws.get(raw.product_id.id, 0.0) - old_raws.get(raw.product_id.id, 0.0)
+                    raw_qty = float_round(raw_qty, precision_rounding=raw.product_uom.rounding)
+                    if raw_qty and raw not in skip:
+                        raw_deltas[raw] += raw_qty
+                        todo.append((raw, raw_qty))
+            elif ipvl.has_moves:
+                pending[ipvl] += dif_qty
+        for ipvl, dif_qty in pending.items():
+            ipvl.pending_qty = ipvl.pending_qty + dif_qty
+        return raw_deltas
+
+    def _write_request_deltas(self, deltas):
+        """Write the changes of demand already propagated, one write per distinct quantity."""
+        lines_by_qty = defaultdict(lambda: self.browse())
+        for ipvl, delta in deltas.items():
+            if delta:
+                lines_by_qty[ipvl.request_qty + delta] |= ipvl
+        for qty, lines in lines_by_qty.items():
+            lines.with_context(ipv_request_qty_applied=True).write({'request_qty': qty})
+
+    @api.multi
+    def _flush_pending_qty(self):
+        """Create one move per line for the accumulated change of demand, increases and decreases are
+        already netted in pending_qty."""
+        lines = self.filtered(lambda l: not float_is_zero(l.pending_qty, precision_rounding=l.product_uom.rounding))
+        for ipvl in lines:
+            ipvl._create_demand_move(ipvl.pending_qty)
+        lines.write({'pending_qty': 0.0})
+        return True
 
+    def _create_demand_move(self, dif_qty):
+        self.ensure_one()
+        ipv_id = self.ipv_id
+        workplace_id = ipv_id.workplace_id
+        dest_loc = self._get_dest_loc()
+
+        move = self.env['stock.move'].create({
+            'name': '%s(%s)' % (self.ipv_id.name, self.product_id.name),
+            'ipvl_id': self.id,
+            'picking_type_id': self.env.ref('stock_ipv.ipv_picking_type').id,
+            'product_id': self.product_id.id,
+            'product_uom_qty': dif_qty,
+            'product_uom': self.product_uom.id,
+            'location_id': ipv_id.workplace_id.stock_loc.id,
+            'location_dest_id': dest_loc.id,
+            # 'procure_method': 'make_to_stock',
+            'origin': ipv_id.name,
+            # 'warehouse_id': self.workplace_id.stock_loc.get_warehouse().id,
+            'group_id': ipv_id.procurement_group_id.id
+
+        })
+        return move._action_confirm(merge_into=(self.move_ids - move))
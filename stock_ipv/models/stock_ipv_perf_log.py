@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import time
+from contextlib import contextmanager
+
+from odoo import models, fields, api
+from odoo.tools.misc import str2bool
+
+
+class StockIpvPerfLog(models.Model):
+    _name = 'stock.ipv.perf.log'
+    _description = 'IPV Performance Log'
+    _order = 'id desc'
+
+    ipv_id = fields.Many2one('stock.ipv', string='IPV Reference', index=True, ondelete='cascade', readonly=True)
+    workplace_id = fields.Many2one('ipv.work.place', string='Work Place', index=True, readonly=True)
+    step = fields.Selection([
+        ('action_assign', 'Check Availability'),
+        ('lock', 'Lock Quants'),
+        ('generate_moves', 'Generate Moves'),
+        ('action_confirm', 'Confirm Moves'),
+        ('reserve', 'Reserve'),
+        ('set_quantity_done', 'Set Quantities Done'),
+        ('action_done', 'Validate Pickings'),
+        ('close', 'Close'),
+    ], required=True, readonly=True)
+    duration = fields.Float('Duration (ms)', group_operator='avg', readonly=True)
+    query_count = fields.Integer('Queries', group_operator='avg', readonly=True)
+    record_count = fields.Integer('Records', group_operator='avg', readonly=True,
+                                  help='Lines, moves or pickings processed by the step.')
+    retry_count = fields.Integer('Retries', readonly=True, help='Lock conflicts retried by the step.')
+
+    @api.model
+    def _is_enabled(self):
+        return str2bool(self.env['ir.config_parameter'].sudo().get_param('stock_ipv.perf_log', 'False'))
+
+    @contextmanager
+    def _track(self, ipv, step, records=None):
+        """Log wall time and SQL queries of the wrapped block when stock_ipv.perf_log is enabled.
+
+        Yields a dict where the block can put extra values for the log, like retry_count."""
+        extra = {}
+        if not self._is_enabled():
+            yield extra
+            return
+        cr = self.env.cr
+        query_count = cr.sql_log_count
+        start = time.time()
+        yield extra
+        extra.update({
+            'ipv_id': ipv.id,
+            'workplace_id': ipv.workplace_id.id,
+            'step': step,
+            'duration': (time.time() - start) * 1000.0,
+            'query_count': cr.sql_log_count - query_count,
+            'record_count': len(records) if records is not None else 0,
+        })
+        self.sudo().create(extra)
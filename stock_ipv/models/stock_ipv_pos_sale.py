@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api
+
+
+class StockIpvPosSale(models.Model):
+    _name = 'stock.ipv.pos.sale'
+    _description = 'IPV POS Sales'
+    _order = 'ipv_id, product_id'
+
+    ipv_id = fields.Many2one('stock.ipv', string='IPV Reference', required=True, index=True, ondelete='cascade')
+    product_id = fields.Many2one('product.product', 'Product', required=True, readonly=True)
+    sold_qty = fields.Float('Sold', readonly=True, help='Quantity sold in the POS during the turn.')
+    consumed_qty = fields.Float('Consumed', readonly=True, help='Stock consumption of the turn, set at close.')
+    difference_qty = fields.Float('Difference', readonly=True, help='Consumed minus sold, set at close.')
+
+    _sql_constraints = [
+        ('ipv_product_uniq', 'unique(ipv_id, product_id)', 'A product can only be once per IPV.'),
+    ]
+
+
+class PosOrder(models.Model):
+    _inherit = 'pos.order'
+
+    def _update_ipv_sales(self):
+        locations = self.mapped('location_id')
+        if locations:
+            # Los usuarios del TPV no tienen acceso a los IPV
+            self.env['stock.ipv'].sudo().search([('state', '=', 'open'),
+                                                 ('workplace_id.sales_loc', 'in', locations.ids)])._update_pos_sales()
+
+    @api.model
+    def create_from_ui(self, orders):
+        # create_from_ui paga cada orden, se actualiza una sola vez al final
+        order_ids = super(PosOrder, self.with_context(ipv_skip_pos_sync=True)).create_from_ui(orders)
+        self.browse(order_ids)._update_ipv_sales()
+        return order_ids
+
+    @api.multi
+    def action_pos_order_paid(self):
+        res = super(PosOrder, self).action_pos_order_paid()
+        if not self.env.context.get('ipv_skip_pos_sync'):
+            self._update_ipv_sales()
+        return res
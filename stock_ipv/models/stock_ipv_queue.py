@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from datetime import timedelta
+
+from odoo import models, fields, api
+from odoo.tools.misc import str2bool
+
+_logger = logging.getLogger(__name__)
+
+
+class StockIpvQueue(models.Model):
+    _name = 'stock.ipv.queue'
+    _description = 'IPV Background Job'
+    _order = 'id'
+
+    ipv_id = fields.Many2one('stock.ipv', string='IPV Reference', required=True, index=True, ondelete='cascade')
+
+    action = fields.Selection([
+        ('open', 'Open'),
+        ('validate', 'Validate'),
+    ], required=True, readonly=True)
+
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], string='Status', default='pending', required=True, index=True, readonly=True)
+
+    progress = fields.Float('Progress', readonly=True, help='Percentage of the pickings already processed.')
+    error = fields.Text('Error', readonly=True)
+    date_started = fields.Datetime('Started', readonly=True)
+    date_done = fields.Datetime('Done date', readonly=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+
+    @api.model
+    def _is_enabled(self):
+        return str2bool(self.env['ir.config_parameter'].sudo().get_param('stock_ipv.async_open', 'False'))
+
+    @api.model
+    def _process_queue(self):
+        """Cron: run the pending jobs, committing after every chunk of pickings."""
+        self._recover_stale_jobs()
+        for job in self.search([('state', '=', 'pending')]):
+            job._run()
+
+    @api.model
+    def _recover_stale_jobs(self):
+        """Requeue the jobs left running by a killed worker (stock_ipv.queue_timeout minutes), a job that
+        already used stock_ipv.queue_attempts attempts is failed instead."""
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        timeout = int(get_param('stock_ipv.queue_timeout', 30))
+        max_attempts = int(get_param('stock_ipv.queue_attempts', 3))
+        stale = self.search([('state', '=', 'running'),
+                             ('date_started', '<', fields.Datetime.now() - timedelta(minutes=timeout))])
+        if not stale:
+            return
+        failed = stale.filtered(lambda job: job.attempts >= max_attempts)
+        message = 'El trabajo se interrumpio %s veces sin terminar.' % max_attempts
+        failed.write({'state': 'failed', 'error': message, 'date_done': fields.Datetime.now()})
+        failed.mapped('ipv_id').write({'error_message': message})
+        (stale - failed).write({'state': 'pending'})
+        self.env.cr.commit()
+
+    def _run(self):
+        self.ensure_one()
+        ipv = self.ipv_id
+        chunk_size = int(self.env['ir.config_parameter'].sudo().get_param('stock_ipv.async_chunk_size', 20))
+        self.write({'state': 'running', 'progress': 0.0, 'date_started': fields.Datetime.now(),
+                    'attempts': self.attempts + 1})
+        self.env.cr.commit()
+        try:
+            ipv._prepare_validate()
+            pickings = ipv.picking_ids.filtered(lambda p: p.state != 'done')
+            for index in range(0, len(pickings), chunk_size):
+                chunk = pickings[index:index + chunk_size]
+                # Los bloqueos se liberan en cada commit
+                moves = chunk.mapped('move_lines')
+                ipv._lock_quants(moves.mapped('product_id'),
+                                 moves.mapped('location_id') | moves.mapped('location_dest_id'))
+                with self.env['stock.ipv.perf.log']._track(ipv, 'action_done', chunk):
+                    chunk.action_done()
+                self.progress = 100.0 * min(index + chunk_size, len(pickings)) / len(pickings)
+                self.env.cr.commit()
+            if self.action == 'open' and all(pick.state == 'done' for pick in ipv.picking_ids):
+                ipv.write({'date_open': fields.Datetime.now(), 'error_message': False})
+            self.write({'state': 'done', 'progress': 100.0, 'date_done': fields.Datetime.now()})
+            self.env.cr.commit()
+        except Exception as e:
+            _logger.exception('IPV %s: background %s failed', ipv.name, self.action)
+            self.env.cr.rollback()
+            self.env.clear()
+            message = str(e)
+            self.write({'state': 'failed', 'error': message, 'date_done': fields.Datetime.now()})
+            ipv.error_message = message
+            self.env.cr.commit()
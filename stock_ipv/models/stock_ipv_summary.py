@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api
+
+
+class StockIpvSummary(models.Model):
+    _name = 'stock.ipv.summary'
+    _description = 'Archived IPV Summary'
+    _order = 'date_close desc, id'
+
+    ipv_id = fields.Many2one('stock.ipv', string='IPV Reference', required=True, index=True, ondelete='cascade')
+    workplace_id = fields.Many2one('ipv.work.place', string='Work Place', index=True, readonly=True)
+    product_id = fields.Many2one('product.product', 'Product', required=True, readonly=True)
+    is_raw = fields.Boolean(string='Is Raw Material', readonly=True)
+    date_close = fields.Datetime('Close date', readonly=True)
+    initial_stock_qty = fields.Float('Initial Stock', readonly=True)
+    request_qty = fields.Float('Demand', readonly=True)
+    final_stock_qty = fields.Float('Final Stock', readonly=True)
+    consumed_qty = fields.Float('Consumed', readonly=True)
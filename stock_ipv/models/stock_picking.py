@@ -1,4 +1,3 @@
-
 from odoo import models, fields, api
 
 
@@ -6,3 +5,8 @@ class StockPicking(models.Model):
     _inherit = 'stock.picking'
 
     ipv_id = fields.Many2one('stock.ipv', ondelete='cascade')
+
+    @api.model
+    def _sweep_empty_ipv_pickings(self):
+        """Cron: delete in bulk the IPV pickings left without moves."""
+        self.search([('ipv_id', '!=', False), ('move_lines', '=', False)]).unlink()
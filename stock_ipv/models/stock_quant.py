@@ -0,0 +1,21 @@
+from odoo import models, api
+
+
+class StockQuant(models.Model):
+    _inherit = 'stock.quant'
+
+    @api.model
+    def _get_ipv_quantities(self, location, products):
+        """Cantidad a mano de ``products`` en ``location`` (y sus hijas) con un solo read_group.
+
+        :return: dict {product_id: quantity}
+        """
+        if not products:
+            return {}
+        domain = [('product_id', 'in', products.ids)]
+        if location:
+            domain.append(('location_id', 'child_of', location.id))
+        else:
+            domain.append(('location_id.usage', '=', 'internal'))
+        groups = self.read_group(domain, ['product_id', 'quantity'], ['product_id'])
+        return {group['product_id'][0]: group['quantity'] for group in groups}
@@ -1,5 +1,11 @@
+import time
+from collections import defaultdict
 
 from odoo import models, fields, api
+from odoo.tools.float_utils import float_round
+
+# Cache de los indicadores del tablero por base de datos: {dbname: (timestamp, data)}
+_DASHBOARD_CACHE = {}
 
 
 class WorkPlace(models.Model):
@@ -25,6 +31,188 @@ class WorkPlace(models.Model):
                                 required=True,
                                 )
     product_tmpl_ids = fields.Many2many('product.template')
+    catalogue_product_ids = fields.Many2many('product.product', 'ipv_work_place_catalogue_rel', 'workplace_id',
+                                             'product_id', string='Catalogue', readonly=True,
+                                             help='Storable products available in POS that can be sold here')
+
+    current_ipv_id = fields.Many2one('stock.ipv', string='Current IPV', compute='_compute_dashboard')
+    current_ipv_state = fields.Selection(lambda self: self.env['stock.ipv']._fields['state'].selection,
+                                         string='IPV Status', compute='_compute_dashboard')
+    open_hours = fields.Float('Open Hours', compute='_compute_dashboard')
+    waiting_picking_count = fields.Integer('Pickings Waiting', compute='_compute_dashboard')
+    low_stock_count = fields.Integer('Lines Low on Stock', compute='_compute_dashboard',
+                                     help='Saleable lines of the current IPV below the stock_ipv.dashboard_low_qty '
+                                          'quantity in the sales area.')
+    consumed_qty = fields.Float('Consumed', compute='_compute_dashboard',
+                                help='Consumption of the saleable lines of the current IPV so far.')
+
     # ipv_ids = fields.One2many('stock.ipv', 'workplace_id')
 
     # pos_id = fields.Many2one('pos.config', string='POS', default=lambda s: s.env.ref('point_of_sale.pos_config_main'))
+
+    @api.model
+    def create(self, vals):
+        res = super(WorkPlace, self).create(vals)
+        res._refresh_catalogue()
+        # Las plantillas asignadas dejan de estar en el catalogo de los demas lugares de trabajo
+        self._refresh_catalogue_products(res._get_catalogue_variants())
+        return res
+
+    @api.multi
+    def write(self, vals):
+        variants = self._get_catalogue_variants() if 'product_tmpl_ids' in vals else None
+        res = super(WorkPlace, self).write(vals)
+        if variants is not None:
+            self._refresh_catalogue_products(variants | self._get_catalogue_variants())
+        return res
+
+    @api.multi
+    def unlink(self):
+        variants = self._get_catalogue_variants()
+        res = super(WorkPlace, self).unlink()
+        self._refresh_catalogue_products(variants.exists())
+        return res
+
+    def _get_catalogue_variants(self):
+        return self.with_context(active_test=False).mapped('product_tmpl_ids.product_variant_ids')
+
+    def _compute_dashboard(self):
+        data = self._get_dashboard_data()
+        for workplace in self:
+            values = data.get(workplace.id, {})
+            workplace.current_ipv_id = values.get('ipv_id', False)
+            workplace.current_ipv_state = values.get('state', False)
+            workplace.open_hours = values.get('open_hours', 0.0)
+            workplace.waiting_picking_count = values.get('waiting_picking_count', 0)
+            workplace.low_stock_count = values.get('low_stock_count', 0)
+            workplace.consumed_qty = values.get('consumed_qty', 0.0)
+
+    @api.model
+    def _get_dashboard_data(self):
+        """Dashboard figures of every workplace, kept for ``stock_ipv.dashboard_ttl`` seconds so the
+        kanban can be reloaded often without hitting the quants each time."""
+        ttl = float(self.env['ir.config_parameter'].sudo().get_param('stock_ipv.dashboard_ttl', '10'))
+        dbname = self.env.cr.dbname
+        cached = _DASHBOARD_CACHE.get(dbname)
+        if cached and time.time() - cached[0] < ttl:
+            return cached[1]
+        # Son cifras por lugar de trabajo, iguales para todos los usuarios
+        data = self.sudo()._read_dashboard_data()
+        _DASHBOARD_CACHE[dbname] = (time.time(), data)
+        return data
+
+    @api.model
+    def _read_dashboard_data(self):
+        """Compute the dashboard of all the workplaces with a fixed number of queries.
+
+        :return: dict {workplace_id: {field: value}}
+        """
+        data = defaultdict(dict)
+        ipvs = self.env['stock.ipv'].search_read([('state', 'not in', ['close', 'cancel'])],
+                                                 ['workplace_id', 'state', 'date_open'], order='create_date desc')
+        now = fields.Datetime.now()
+        ipv_workplace = {}
+        for ipv in ipvs:
+            workplace_id = ipv['workplace_id'][0]
+            if 'ipv_id' in data[workplace_id]:
+                continue
+            ipv_workplace[ipv['id']] = workplace_id
+            data[workplace_id].update({
+                'ipv_id': ipv['id'],
+                'state': ipv['state'],
+                'open_hours': (now - ipv['date_open']).total_seconds() / 3600.0 if ipv['date_open'] else 0.0,
+            })
+        if not ipv_workplace:
+            return dict(data)
+
+        groups = self.env['stock.picking'].read_group(
+            [('ipv_id', 'in', list(ipv_workplace)), ('state', 'in', ['waiting', 'confirmed', 'assigned'])],
+            ['ipv_id'], ['ipv_id'])
+        for group in groups:
+            data[ipv_workplace[group['ipv_id'][0]]]['waiting_picking_count'] = group['ipv_id_count']
+
+        # Cantidades esperadas de las lineas vendibles por lugar de trabajo y producto
+        groups = self.env['stock.ipv.line'].read_group(
+            [('ipv_id', 'in', list(ipv_workplace)), ('is_raw', '=', False), ('saleable_in_pos', '=', True)],
+            ['ipv_id', 'product_id', 'initial_stock_qty', 'request_qty'], ['ipv_id', 'product_id'], lazy=False)
+        expected = {}
+        for group in groups:
+            key = (ipv_workplace[group['ipv_id'][0]], group['product_id'][0])
+            expected[key] = group['initial_stock_qty'] + group['request_qty']
+        if not expected:
+            return dict(data)
+
+        # Cantidad a mano en las areas de venta, un solo read_group para todos los lugares de trabajo
+        workplaces = self.browse({workplace_id for workplace_id, product_id in expected})
+        location_workplace = [(workplace.sales_loc.parent_path, workplace.id) for workplace in workplaces]
+        groups = self.env['stock.quant'].read_group(
+            [('location_id', 'child_of', workplaces.mapped('sales_loc').ids),
+             ('product_id', 'in', list({product_id for workplace_id, product_id in expected}))],
+            ['location_id', 'product_id', 'quantity'], ['location_id', 'product_id'], lazy=False)
+        locations = self.env['stock.location'].browse({group['location_id'][0] for group in groups})
+        parent_paths = {location.id: location.parent_path for location in locations}
+        on_hand = defaultdict(float)
+        for group in groups:
+            parent_path = parent_paths[group['location_id'][0]]
+            for path, workplace_id in location_workplace:
+                if parent_path.startswith(path):
+                    on_hand[(workplace_id, group['product_id'][0])] += group['quantity']
+
+        low_qty = float(self.env['ir.config_parameter'].get_param('stock_ipv.dashboard_low_qty', '1.0'))
+        for key, qty in expected.items():
+            values = data[key[0]]
+            if on_hand[key] < low_qty:
+                values['low_stock_count'] = values.get('low_stock_count', 0) + 1
+            if values.get('state') == 'open':
+                values['consumed_qty'] = float_round(values.get('consumed_qty', 0.0) + qty - on_hand[key],
+                                                     precision_digits=2)
+        return dict(data)
+
+    @api.multi
+    def action_open_current_ipv(self):
+        self.ensure_one()
+        action = self.env.ref('stock_ipv.action_stock_ipv').read()[0]
+        if self.current_ipv_id:
+            action.update({'views': [(False, 'form')], 'res_id': self.current_ipv_id.id})
+        else:
+            action['context'] = {'default_workplace_id': self.id}
+            action['views'] = [(False, 'form')]
+        return action
+
+    @api.model
+    def _refresh_all_catalogues(self):
+        self.search([])._refresh_catalogue()
+
+    @api.multi
+    def _refresh_catalogue(self):
+        """Rebuild the whole catalogue of the workplaces in self."""
+        if not self:
+            return
+        self.env.cr.execute('DELETE FROM ipv_work_place_catalogue_rel WHERE workplace_id IN %s', (tuple(self.ids),))
+        self._insert_catalogue('wp.id IN %s', (tuple(self.ids),))
+
+    @api.model
+    def _refresh_catalogue_products(self, products):
+        """Refresh the catalogue rows of ``products`` only, in every workplace."""
+        if not products:
+            return
+        self.env.cr.execute('DELETE FROM ipv_work_place_catalogue_rel WHERE product_id IN %s', (tuple(products.ids),))
+        self._insert_catalogue('pp.id IN %s', (tuple(products.ids),))
+
+    @api.model
+    def _insert_catalogue(self, where, params):
+        """Insert the catalogue rows matching ``where``: the templates of each workplace plus the ones that are
+        not bound to any workplace, only storable products available in POS."""
+        field = self._fields['product_tmpl_ids']
+        self.env.cr.execute("""
+            INSERT INTO ipv_work_place_catalogue_rel (workplace_id, product_id)
+            SELECT wp.id, pp.id
+              FROM ipv_work_place wp
+              JOIN product_template pt ON pt.active AND pt.available_in_pos AND pt.type = 'product'
+              JOIN product_product pp ON pp.product_tmpl_id = pt.id AND pp.active
+             WHERE {where}
+               AND (EXISTS (SELECT 1 FROM {rel} r WHERE r.{col1} = wp.id AND r.{col2} = pt.id)
+                    OR NOT EXISTS (SELECT 1 FROM {rel} r WHERE r.{col2} = pt.id))
+        """.format(where=where, rel=field.relation, col1=field.column1, col2=field.column2), params)
+        self.invalidate_cache(['catalogue_product_ids'])
+        self.env['product.product'].invalidate_cache(['ipv_catalogue_ids'])
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+
+from . import test_concurrent_reservation
+from . import test_generate_moves
+from . import test_on_hand_qty
+from . import test_performance
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from odoo.tests import common
+
+_logger = logging.getLogger(__name__)
+
+SIZES = [10, 100, 1000]
+
+# La precarga lee de PREFETCH_MAX en PREFETCH_MAX registros, sus consultas crecen a saltos y no por linea
+PREFETCH_ALLOWANCE = 20
+# El tiempo por linea de un tamano no supera en mas de esta proporcion al del tamano anterior
+TIME_GROWTH = 1.5
+# Segundos de margen, absorben el ruido de las operaciones cortas
+TIME_SLACK = 1.0
+
+# Campos de las lineas que carga el formulario del IPV
+LINE_FORM_FIELDS = ['product_id', 'bom_id', 'product_uom', 'elaboration_loc', 'initial_stock_qty', 'on_hand_qty',
+                    'request_qty', 'consumed_qty', 'state', 'is_manufactured', 'saleable_in_pos',
+                    'string_availability_info']
+
+
+class IpvPerformanceCase(common.TransactionCase):
+    """Workplace with merchandise and multi-level manufactured products (dish <- sauce <- raws), the sauce is
+    elaborated in its own area. Every product has stock in the stock location."""
+
+    # Una linea de cada DISH_EVERY es un plato con receta de varios niveles, las demas son mercancia
+    DISH_EVERY = 10
+    STOCK_QTY = 1000000.0
+
+    def setUp(self):
+        super(IpvPerformanceCase, self).setUp()
+        self.stock_loc = self.env.ref('stock.stock_location_stock')
+        self.elaboration_loc = self.env.ref('stock_ipv.ipv_location_elaboration')
+        self.sales_loc = self.env.ref('stock_ipv.ipv_location_sales')
+        self.sauce_loc = self.env['stock.location'].create({
+            'name': 'Sauce Kitchen',
+            'usage': 'internal',
+            'location_id': self.stock_loc.location_id.id,
+        })
+        self.workplace = self.env['ipv.work.place'].create({
+            'name': 'Bar',
+            'stock_loc': self.stock_loc.id,
+            'elaboration_loc': self.elaboration_loc.id,
+            'sales_loc': self.sales_loc.id,
+        })
+        Product = self.env['product.product']
+        self.raws = Product.create([{
+            'name': 'Raw %s' % index,
+            'type': 'product',
+            'available_in_pos': False,
+        } for index in range(4)])
+        self.sauce = Product.create({
+            'name': 'Sauce',
+            'type': 'product',
+            'available_in_pos': False,
+            'elaboration_loc': self.sauce_loc.id,
+        })
+        self._create_bom(self.sauce, [(self.raws[0], 0.5), (self.raws[1], 0.25)])
+        self._add_stock(self.raws | self.sauce, self.stock_loc)
+        self.products = Product.browse()
+
+    def _create_bom(self, product, components):
+        return self.env['mrp.bom'].create({
+            'product_tmpl_id': product.product_tmpl_id.id,
+            'product_qty': 1.0,
+            'type': 'normal',
+            'bom_line_ids': [(0, 0, {'product_id': component.id, 'product_qty': qty})
+                             for component, qty in components],
+        })
+
+    def _add_stock(self, products, location, qty=None):
+        Quant = self.env['stock.quant']
+        for product in products:
+            Quant._update_available_quantity(product, location, qty or self.STOCK_QTY)
+
+    def _get_products(self, count):
+        """Saleable products for ``count`` lines, created once and reused by the bigger sizes."""
+        missing = count - len(self.products)
+        if missing > 0:
+            start = len(self.products)
+            new_products = self.env['product.product'].create([{
+                'name': 'Saleable %s' % index,
+                'type': 'product',
+                'available_in_pos': True,
+            } for index in range(start, count)])
+            merchandise = self.env['product.product']
+            for index, product in zip(range(start, count), new_products):
+                if index % self.DISH_EVERY == 0:
+                    self._create_bom(product, [(self.sauce, 0.2), (self.raws[1], 0.1), (self.raws[2], 1.0)])
+                else:
+                    merchandise |= product
+            self._add_stock(merchandise, self.stock_loc)
+            self.products |= new_products
+        return self.products[:count]
+
+    def _line_vals(self, ipv, products, qty=1.0):
+        IpvLine = self.env['stock.ipv.line']
+        return [{
+            'ipv_id': ipv.id,
+            'product_id': product.id,
+            'bom_id': IpvLine._get_default_bom(product).id,
+            'request_qty': qty,
+        } for product in products]
+
+    def _create_ipv(self, count, qty=1.0):
+        ipv = self.env['stock.ipv'].create({'workplace_id': self.workplace.id})
+        self.env['stock.ipv.line'].create(self._line_vals(ipv, self._get_products(count), qty))
+        return ipv
+
+    def _count_queries(self, func, *args):
+        count0 = self.cr.sql_log_count
+        func(*args)
+        return self.cr.sql_log_count - count0
+
+    def _measure(self, func, *args):
+        """Queries and seconds spent by ``func(*args)``."""
+        count0 = self.cr.sql_log_count
+        start = time.time()
+        func(*args)
+        return self.cr.sql_log_count - count0, time.time() - start
+
+    def _move_vals(self, lines):
+        """Values of the moves of ``lines`` as _generate_moves builds them, for plain moves in their own
+        procurement group: the stock work of the IPV without the IPV."""
+        group = self.env['procurement.group'].create({'name': 'Baseline', 'move_type': 'one'})
+        picking_type = self.env.ref('stock_ipv.ipv_picking_type')
+        warehouse = self.stock_loc.get_warehouse()
+        vals_list = []
+        for ipvl in lines.filtered('request_qty'):
+            if ipvl.is_manufactured:
+                source = ipvl.elaboration_loc or self.workplace.elaboration_loc
+            else:
+                source = self.stock_loc
+            vals_list.append({
+                'name': 'Baseline',
+                'picking_type_id': picking_type.id,
+                'product_id': ipvl.product_id.id,
+                'product_uom_qty': ipvl.request_qty,
+                'product_uom': ipvl.product_uom.id,
+                'location_id': source.id,
+                'location_dest_id': ipvl._get_dest_loc().id,
+                'warehouse_id': warehouse.id,
+                'group_id': group.id,
+            })
+        return vals_list
+
+    def assertLineBudget(self, label, prepare, per_line, sizes=SIZES):
+        """Measure an operation on IPVs of every size in ``sizes`` and check what each extra line costs.
+
+        ``prepare(size)`` builds the IPV outside of the count, with the cache as the operation should find it,
+        and returns a tuple (operation, baseline queries, check). The baseline is the count of the same stock work done on plain moves, 0 when there is none,
+        and ``check`` is called after the operation when it is set.
+
+        The smallest size sets the budget of the bigger ones: its queries, ``per_line`` queries per extra
+        line, the extra queries of the baseline and PREFETCH_ALLOWANCE. The time per line can grow at most
+        TIME_GROWTH between two sizes.
+
+        :return: dict {size: (queries, seconds)}
+        """
+        results = {}
+        first = None
+        for size in sizes:
+            operation, baseline, check = prepare(size)
+            if first is None:
+                queries, seconds = self._measure(operation)
+                first = (size, queries, baseline)
+            else:
+                first_size, first_queries, first_baseline = first
+                budget = first_queries + per_line * (size - first_size) + (baseline - first_baseline) + \
+                    PREFETCH_ALLOWANCE
+                with self.assertQueryCount(budget):
+                    queries, seconds = self._measure(operation)
+                previous_size = sizes[sizes.index(size) - 1]
+                previous_seconds = results[previous_size][1]
+                self.assertLessEqual(
+                    seconds, previous_seconds * TIME_GROWTH * size / previous_size + TIME_SLACK,
+                    '%s: %s lines took %.2fs, %s lines %.2fs' % (label, size, seconds, previous_size, previous_seconds))
+            if check:
+                check()
+            results[size] = (queries, seconds)
+            _logger.info('%s %s lines: %s queries (baseline %s), %.3fs', label, size, queries, baseline, seconds)
+        return results
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+import time
+
+from psycopg2 import OperationalError
+
+from odoo import api, SUPERUSER_ID
+from odoo.service.model import PG_CONCURRENCY_ERRORS_TO_RETRY
+from odoo.tests import common, tagged
+
+# Bloqueo de los quants solo para estas llamadas, sin tocar los parametros del sistema. La espera no caduca:
+# los turnos se serializan y el resultado no depende de la velocidad de la maquina.
+LOCK_CONTEXT = {
+    'ipv_lock_reservation': True,
+    'ipv_lock_retries': 1,
+    'ipv_lock_timeout': 10 * 60 * 1000,
+}
+
+
+@tagged('post_install', '-at_install', 'performance')
+class TestConcurrentReservation(common.TransactionCase):
+    """Many turns checking availability and opening from the same stock location at once.
+
+    The threads need committed data, so the fixture is committed with its own cursor and removed by a
+    cleanup registered before the test runs. Each thread retries on concurrency errors like an RPC call
+    does, a turn waiting on the quant lock gets a serialization failure when the holder commits."""
+
+    THREADS = 20
+    STOCK_QTY = 15.0
+    PRODUCTS = 5
+
+    def setUp(self):
+        super(TestConcurrentReservation, self).setUp()
+        self.fixture = {'workplace': [], 'products': [], 'ipvs': []}
+        self.addCleanup(self._cleanup)
+        with api.Environment.manage(), self.registry.cursor() as cr:
+            self._build_fixture(api.Environment(cr, SUPERUSER_ID, {}))
+
+    def _build_fixture(self, env):
+        stock_loc = env.ref('stock.stock_location_stock')
+        workplace = env['ipv.work.place'].create({'name': 'Concurrent Bar', 'stock_loc': stock_loc.id})
+        products = env['product.product'].create([{
+            'name': 'Concurrent %s' % index,
+            'type': 'product',
+            'available_in_pos': True,
+        } for index in range(self.PRODUCTS)])
+        for product in products:
+            env['stock.quant']._update_available_quantity(product, stock_loc, self.STOCK_QTY)
+        ipvs = env['stock.ipv']
+        for index in range(self.THREADS):
+            ipv = env['stock.ipv'].create({'workplace_id': workplace.id})
+            env['stock.ipv.line'].create([{
+                'ipv_id': ipv.id,
+                'product_id': product.id,
+                'request_qty': 1.0,
+            } for product in products])
+            ipvs |= ipv
+        # Se rellena al final, si la creacion falla no se confirma nada que borrar
+        self.fixture.update({'workplace': workplace.ids, 'products': products.ids, 'ipvs': ipvs.ids})
+
+    def _cleanup(self):
+        if not self.fixture['ipvs']:
+            return
+        ipv_ids = tuple(self.fixture['ipvs'])
+        product_ids = tuple(self.fixture['products'])
+        with api.Environment.manage(), self.registry.cursor() as cr:
+            # Las movidas hechas no se pueden borrar con el ORM
+            cr.execute("SELECT id, procurement_group_id FROM stock_ipv WHERE id IN %s", (ipv_ids,))
+            group_ids = tuple(row[1] for row in cr.fetchall() if row[1]) or (0,)
+            cr.execute("SELECT id FROM stock_picking WHERE ipv_id IN %s", (ipv_ids,))
+            picking_ids = tuple(row[0] for row in cr.fetchall()) or (0,)
+            cr.execute("DELETE FROM stock_move_line WHERE product_id IN %s", (product_ids,))
+            cr.execute("DELETE FROM stock_move WHERE product_id IN %s", (product_ids,))
+            cr.execute("DELETE FROM stock_picking WHERE id IN %s", (picking_ids,))
+            cr.execute("DELETE FROM stock_quant WHERE product_id IN %s", (product_ids,))
+            cr.execute("DELETE FROM mail_message WHERE model = 'stock.ipv' AND res_id IN %s", (ipv_ids,))
+            cr.execute("DELETE FROM stock_ipv WHERE id IN %s", (ipv_ids,))
+            cr.execute("DELETE FROM procurement_group WHERE id IN %s", (group_ids,))
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            env['product.product'].browse(self.fixture['products']).mapped('product_tmpl_id').unlink()
+            env['ipv.work.place'].browse(self.fixture['workplace']).unlink()
+
+    def _open_turn(self, ipv_id, barrier, errors):
+        """Check availability and open one turn in its own transaction, retried on concurrency errors."""
+        with api.Environment.manage(), self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, LOCK_CONTEXT)
+            barrier.wait()
+            # Cada ronda confirma al menos un turno, THREADS intentos bastan
+            for attempt in range(self.THREADS):
+                try:
+                    ipv = env['stock.ipv'].browse(ipv_id)
+                    ipv.action_assign()
+                    if ipv.state == 'ready':
+                        ipv.button_open()
+                    cr.commit()
+                    return
+                except OperationalError as e:
+                    cr.rollback()
+                    env.clear()
+                    if e.pgcode not in PG_CONCURRENCY_ERRORS_TO_RETRY:
+                        errors.append('IPV %s: %s' % (ipv_id, e))
+                        return
+                    time.sleep(random.uniform(0.0, 0.1))
+                except Exception as e:
+                    cr.rollback()
+                    errors.append('IPV %s: %s' % (ipv_id, e))
+                    return
+            errors.append('IPV %s: too many concurrency errors' % ipv_id)
+
+    def test_concurrent_open(self):
+        errors = []
+        barrier = threading.Barrier(self.THREADS)
+        threads = [threading.Thread(target=self._open_turn, args=(ipv_id, barrier, errors))
+                   for ipv_id in self.fixture['ipvs']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertFalse(errors, 'Concurrent openings failed:\n%s' % '\n'.join(errors))
+
+        with api.Environment.manage(), self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            workplace = env['ipv.work.place'].browse(self.fixture['workplace'])
+            quants = env['stock.quant'].search([('product_id', 'in', self.fixture['products'])])
+            for quant in quants:
+                self.assertGreaterEqual(quant.quantity, 0.0)
+                self.assertLessEqual(quant.reserved_quantity, quant.quantity)
+            # Cada IPV pide una unidad de cada producto, solo alcanza para STOCK_QTY turnos
+            ipvs = env['stock.ipv'].browse(self.fixture['ipvs'])
+            self.assertEqual(len(ipvs.filtered(lambda i: i.state == 'open')), self.STOCK_QTY)
+            stock_qty = sum(quants.filtered(lambda q: q.location_id == workplace.stock_loc).mapped('quantity'))
+            sales_qty = sum(quants.filtered(lambda q: q.location_id == workplace.sales_loc).mapped('quantity'))
+            self.assertEqual(stock_qty, 0.0)
+            self.assertEqual(sales_qty, self.STOCK_QTY * self.PRODUCTS)
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tests import tagged
+
+from .common import IpvPerformanceCase
+
+
+@tagged('post_install', '-at_install', 'performance')
+class TestGenerateMoves(IpvPerformanceCase):
+    """_generate_moves creates and confirms the moves of all the lines in one batch.
+
+    The same moves created and confirmed in one batch without the IPV are the baseline: going from 10 to 100
+    lines, _generate_moves may only add the queries the baseline adds, the prefetch aside. Creating or
+    confirming the moves line by line costs more per line than the batch and fails the budget."""
+
+    def test_generate_moves_batched(self):
+        def prepare(size):
+            ipv = self._create_ipv(size)
+            lines = ipv.ipv_lines.filtered(lambda l: not l.is_manufactured)
+            vals_list = self._move_vals(lines)
+            self.env.invalidate_all()
+            baseline = self._count_queries(lambda: self.env['stock.move'].create(vals_list)._action_confirm())
+            self.env.invalidate_all()
+            return (lambda: ipv._generate_moves(lines), baseline,
+                    lambda: self.assertEqual(len(lines.mapped('move_ids')), len(lines.filtered('request_qty'))))
+        self.assertLineBudget('generate_moves', prepare, 0, sizes=[10, 100])
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tests import tagged
+
+from .common import IpvPerformanceCase
+
+
+@tagged('post_install', '-at_install', 'performance')
+class TestOnHandQty(IpvPerformanceCase):
+    """The on hand quantity of an IPV costs one quant query per location, the lines only add the prefetch of
+    their fields: the queries for 100 and 1000 lines stay within the ones for 10 lines."""
+
+    def test_on_hand_qty(self):
+        def prepare(size):
+            lines = self._create_ipv(size).ipv_lines
+            self.env.invalidate_all()
+            return lambda: lines.mapped('on_hand_qty'), 0, None
+        self.assertLineBudget('on_hand_qty', prepare, 0)
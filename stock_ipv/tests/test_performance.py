@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+from odoo import fields
+from odoo.tests import tagged
+
+from .common import IpvPerformanceCase, LINE_FORM_FIELDS
+
+
+@tagged('post_install', '-at_install', 'performance')
+class TestIpvPerformance(IpvPerformanceCase):
+    """Query and wall time budgets of the IPV life cycle with 10, 100 and 1000 lines.
+
+    The stock work of the moves (confirm, reserve, done, availability) costs Odoo queries per move, it is
+    measured on plain moves of the same lines and left out of the budget. What is left is the cost of the IPV
+    itself, which must not grow with its lines."""
+
+    # Consultas por linea extra del propio IPV. Crear una linea cuesta su INSERT, y un plato de cada
+    # DISH_EVERY el enlace con sus materias primas y la lectura de su receta. El resto se hace en lote.
+    PER_LINE = {
+        'create': 2,
+        'action_assign': 0,
+        'button_open': 0,
+        'button_close': 0,
+        'workplace onchange': 0,
+        'form load': 0,
+    }
+
+    def test_create_lines(self):
+        def prepare(size):
+            ipv = self.env['stock.ipv'].create({'workplace_id': self.workplace.id})
+            vals_list = self._line_vals(ipv, self._get_products(size))
+            return (lambda: self.env['stock.ipv.line'].create(vals_list), 0,
+                    lambda: self.assertEqual(len(ipv.saleable_lines), size))
+        self.assertLineBudget('create', prepare, self.PER_LINE['create'])
+
+    def test_action_assign(self):
+        def prepare(size):
+            ipv = self._create_ipv(size)
+            vals_list = self._move_vals(ipv.ipv_lines.filtered(lambda l: not l.is_manufactured))
+            self.env.invalidate_all()
+            baseline = self._count_queries(
+                lambda: self.env['stock.move'].create(vals_list)._action_confirm().mapped('picking_id').action_assign())
+            self.env.invalidate_all()
+            return ipv.action_assign, baseline, lambda: self.assertEqual(ipv.state, 'ready')
+        self.assertLineBudget('action_assign', prepare, self.PER_LINE['action_assign'])
+
+    def _baseline_open(self, ipv):
+        """Queries of opening plain moves of the lines: the manufactured ones are created and confirmed, then
+        every move is done."""
+        Move = self.env['stock.move']
+        moves = Move.create(self._move_vals(ipv.ipv_lines.filtered(lambda l: not l.is_manufactured)))
+        moves._action_confirm().mapped('picking_id').action_assign()
+        vals_list = self._move_vals(ipv.ipv_lines.filtered('is_manufactured'))
+        self.env.invalidate_all()
+
+        def open_moves():
+            all_moves = moves | Move.create(vals_list)._action_confirm()
+            for move in all_moves:
+                move._set_quantity_done(move.product_uom_qty)
+            all_moves.mapped('picking_id').action_done()
+        baseline = self._count_queries(open_moves)
+        self.env.invalidate_all()
+        return baseline
+
+    def test_button_open(self):
+        def prepare(size):
+            ipv = self._create_ipv(size)
+            ipv.action_assign()
+            baseline = self._baseline_open(ipv)
+            return ipv.button_open, baseline, lambda: self.assertEqual(ipv.state, 'open')
+        self.assertLineBudget('button_open', prepare, self.PER_LINE['button_open'])
+
+    def test_button_close(self):
+        def prepare(size):
+            ipv = self._create_ipv(size)
+            ipv.action_assign()
+            ipv.button_open()
+            return ipv.button_close, 0, lambda: self.assertEqual(ipv.state, 'close')
+        self.assertLineBudget('button_close', prepare, self.PER_LINE['button_close'])
+
+    def test_onchange_workplace(self):
+        """The carry over of the last closed turn reads the stock of all its lines at once."""
+        def prepare(size):
+            last = self._create_ipv(size)
+            last.write({'date_open': fields.Datetime.now(), 'date_close': fields.Datetime.now()})
+            self._add_stock(last.saleable_lines.mapped('product_id'), self.sales_loc, 1.0)
+            ipv = self.env['stock.ipv'].new({'workplace_id': self.workplace.id})
+            return ipv._compute_child_lines, 0, lambda: self.assertEqual(len(ipv.saleable_lines), size)
+        self.assertLineBudget('workplace onchange', prepare, self.PER_LINE['workplace onchange'])
+
+    def test_line_form_load(self):
+        def prepare(size):
+            ipv = self._create_ipv(size)
+            ipv.action_assign()
+            lines = ipv.saleable_lines
+            moves = lines.mapped('move_ids')
+            # La disponibilidad de cada movida la calcula stock
+            self.env.invalidate_all()
+            baseline = self._count_queries(moves.read, ['string_availability_info'])
+            self.env.invalidate_all()
+            return lambda: lines.read(LINE_FORM_FIELDS), baseline, None
+        self.assertLineBudget('form load', prepare, self.PER_LINE['form load'])
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import csv
+import io
+import logging
+from collections import defaultdict
+
+from odoo import models, fields, api
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import openpyxl
+except ImportError:
+    _logger.debug('Cannot import openpyxl, xlsx sheets cannot be imported.')
+    openpyxl = None
+
+try:
+    import xlsxwriter
+except ImportError:
+    _logger.debug('Cannot import xlsxwriter, xlsx sheets cannot be exported.')
+    xlsxwriter = None
+
+SHEET_HEADER = ['code', 'name', 'request_qty', 'initial_stock_qty', 'final_stock_qty', 'consumed_qty']
+
+
+class StockIpvSheetWizard(models.TransientModel):
+    _name = 'stock.ipv.sheet.wizard'
+    _description = 'Import/Export IPV Sheet'
+
+    ipv_id = fields.Many2one('stock.ipv', string='IPV Reference', required=True)
+    file_format = fields.Selection([('csv', 'CSV'), ('xlsx', 'Excel')], string='Format', default='csv', required=True)
+    data_file = fields.Binary('File')
+    filename = fields.Char('File Name')
+    batch_size = fields.Integer('Batch Size', default=500, help='Lines created per batch when importing.')
+
+    def _iter_rows(self):
+        """Yield the rows of the uploaded sheet as lists of values.
+
+        The binary field is decoded in memory, only the parsed rows are produced one at a time."""
+        content = io.BytesIO(base64.b64decode(self.data_file))
+        if self.file_format == 'xlsx':
+            if openpyxl is None:
+                raise UserError('Se necesita la libreria openpyxl para importar hojas de Excel.')
+            workbook = openpyxl.load_workbook(content, read_only=True, data_only=True)
+            for row in workbook.active.iter_rows(values_only=True):
+                yield list(row)
+            workbook.close()
+        else:
+            for row in csv.reader(io.TextIOWrapper(content, encoding='utf-8-sig')):
+                yield row
+
+    @staticmethod
+    def _format_code(value):
+        """Text of a code cell, numeric Excel cells like 123 come as 123.0."""
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return str(value if value is not None else '').strip()
+
+    def _get_product_codes(self, codes):
+        """Map the barcodes and internal references in ``codes`` to the products of the workplace catalogue,
+        searching one batch of codes at a time."""
+        result = {}
+        codes = list(codes)
+        for index in range(0, len(codes), self.batch_size or 500):
+            chunk = codes[index:index + (self.batch_size or 500)]
+            products = self.env['product.product'].search_read(
+                [('ipv_catalogue_ids', '=', self.ipv_id.workplace_id.id),
+                 '|', ('barcode', 'in', chunk), ('default_code', 'in', chunk)],
+                ['barcode', 'default_code'])
+            for product in products:
+                for code in (product['default_code'], product['barcode']):
+                    if code:
+                        result[code] = product['id']
+        return result
+
+    def _read_sheet(self):
+        """Read the requested quantity of every code of the sheet, repeated codes are added up.
+
+        :return: dict {code: qty}
+        """
+        rows = self._iter_rows()
+        header = [str(value or '').strip() for value in next(rows, [])]
+        if 'code' not in header or 'request_qty' not in header:
+            raise UserError('La hoja debe tener las columnas code y request_qty.')
+        code_index = header.index('code')
+        qty_index = header.index('request_qty')
+        quantities = defaultdict(float)
+        # La fila 1 es la cabecera
+        for row_number, row in enumerate(rows, 2):
+            code = self._format_code(row[code_index]) if len(row) > code_index else ''
+            if not code:
+                continue
+            value = row[qty_index] if len(row) > qty_index else None
+            try:
+                qty = float(value or 0.0)
+            except (TypeError, ValueError):
+                raise UserError('Fila %s: la cantidad %s del producto %s no es un numero.' % (row_number, value, code))
+            if qty < 0.0:
+                raise UserError('Fila %s: la cantidad del producto %s no puede ser negativa.' % (row_number, code))
+            quantities[code] += qty
+        return quantities
+
+    @api.multi
+    def action_import(self):
+        """Set the demand of the IPV from the sheet through set_demand, the new lines are created in batches.
+
+        Rows of the same product, by a repeated code or by its barcode and internal reference, are merged
+        before the demand is applied."""
+        self.ensure_one()
+        if not self.data_file:
+            raise UserError('Seleccione el fichero a importar.')
+        quantities = self._read_sheet()
+        codes = self._get_product_codes(quantities)
+        unknown = [code for code in quantities if code not in codes]
+        if unknown:
+            raise UserError('Productos no encontrados: %s' % ', '.join(unknown[:50]))
+        demand = defaultdict(float)
+        for code, qty in quantities.items():
+            demand[codes[code]] += qty
+        self.ipv_id.set_demand(demand, batch_size=self.batch_size)
+        return {'type': 'ir.actions.act_window_close'}
+
+    @api.multi
+    def action_export(self):
+        """Write the lines of the IPV and their quantities in the same format used to import them."""
+        self.ensure_one()
+        ipv = self.ipv_id
+        lines = ipv.saleable_lines
+        rows = [[ipvl.product_id.default_code or ipvl.product_id.barcode or '',
+                 ipvl.product_id.name,
+                 ipvl.request_qty,
+                 ipvl.initial_stock_qty,
+                 ipvl.final_stock_qty,
+                 ipvl.consumed_qty] for ipvl in lines]
+
+        output = io.BytesIO()
+        if self.file_format == 'xlsx':
+            if xlsxwriter is None:
+                raise UserError('Se necesita la libreria xlsxwriter para exportar hojas de Excel.')
+            workbook = xlsxwriter.Workbook(output, {'in_memory': True})
+            worksheet = workbook.add_worksheet(ipv.name)
+            for row_index, row in enumerate([SHEET_HEADER] + rows):
+                worksheet.write_row(row_index, 0, row)
+            workbook.close()
+        else:
+            text = io.TextIOWrapper(output, encoding='utf-8', newline='')
+            writer = csv.writer(text)
+            writer.writerow(SHEET_HEADER)
+            writer.writerows(rows)
+            text.flush()
+            text.detach()
+        self.write({
+            'data_file': base64.b64encode(output.getvalue()),
+            'filename': '%s.%s' % (ipv.name, self.file_format),
+        })
+        return {
+            'type': 'ir.actions.act_url',
+            'url': '/web/content/?model=%s&id=%s&field=data_file&filename_field=filename&download=true'
+                   % (self._name, self.id),
+            'target': 'self',
+        }